@@ -2,9 +2,10 @@
 
 import pprint, traceback
 import math, urllib, sys, os, re, hashlib
-import rpy2.robjects as ro
 from metagenome import Metagenome
 from ipyTools import *
+from mmatrix import open_mapped, SUFFIX as MMAP_SUFFIX
+from shmstore import attach_matrix, publish_matrix
 from collections import defaultdict
 from datetime import datetime
 import IPython.lib.display
@@ -95,24 +96,39 @@ class AnalysisSet(object):
                     values['abundance'] = self._get_analysis(self.all_mgs, 'function', ont, 'abundance', self.function_source, biom_dir)
                 setattr(self, ont, values)
 
+    @instrument.timed('AnalysisSet.load_matrix')
     def _get_analysis(self, ids, annotation, level, result_type, source, biom_dir):
         # this needs to be created same way as matrix api builds it
         matrix_id = "_".join(sorted(ids))+"_"+"_".join([annotation, level, source, Ipy.MATRIX['hit_type'], result_type])
         matrix_id += "_%d_%d_%d"%(Ipy.MATRIX['e_val'], Ipy.MATRIX['ident'], Ipy.MATRIX['alen'])
         matrix_md5 = hashlib.md5(matrix_id).hexdigest()
         sub_def_name = self.defined_name+'.'+level+"['"+result_type+"']"
-        # load from biom_dir
+        # attach to matrix published by another kernel, private (auth) matrices are never shared
+        shared = None if self._auth else attach_matrix(matrix_md5)
+        if shared:
+            if Ipy.DEBUG:
+                sys.stdout.write("attaching shared matrix %s (%s) ... \n"%(matrix_md5, matrix_id))
+            analysis = Analysis(biom=shared, auth=self._auth, def_name=sub_def_name)
+            analysis._shm_key = matrix_md5
+            return analysis
+        # load from biom_dir, memory-mapped files (see mmatrix.py) first
         if biom_dir:
             md5_file = biom_dir+'/'+matrix_md5+'.biom'
             id_file  = biom_dir+'/'+matrix_id+'.biom'
+            for name in (matrix_md5, matrix_id):
+                mfile = biom_dir+'/'+name+MMAP_SUFFIX+'.json'
+                if os.path.isfile(mfile):
+                    if Ipy.DEBUG:
+                        sys.stdout.write("mapping %s%s from dir %s ... \n"%(name, MMAP_SUFFIX, biom_dir))
+                    return Analysis(mfile=mfile, auth=self._auth, def_name=sub_def_name)
             if os.path.isfile(md5_file):
                 if Ipy.DEBUG:
                     sys.stdout.write("loading %s.biom (%s) from dir %s ... \n"%(matrix_md5, matrix_id, biom_dir))
-                return Analysis(bfile=md5_file, auth=self._auth, def_name=sub_def_name)
+                return self._share(Analysis(bfile=md5_file, auth=self._auth, def_name=sub_def_name), matrix_md5)
             elif os.path.isfile(id_file):
                 if Ipy.DEBUG:
                     sys.stdout.write("loading %s.biom from dir %s ... \n"%(matrix_id, biom_dir))
-                return Analysis(bfile=id_file, auth=self._auth, def_name=sub_def_name)
+                return self._share(Analysis(bfile=id_file, auth=self._auth, def_name=sub_def_name), matrix_md5)
             else:
                 sys.stderr.write("no biom file for %s in dir %s\n"%(matrix_id, biom_dir))
                 return None
@@ -130,8 +146,18 @@ class AnalysisSet(object):
             keyArgs['def_name'] = sub_def_name
             if self._auth:
                 keyArgs['auth'] = self._auth
-            return Analysis(**keyArgs)
+            return self._share(Analysis(**keyArgs), matrix_md5)
+
+    def _share(self, analysis, matrix_md5):
+        """publish loaded matrix for other kernels and switch analysis to the shared copy, unless loaded with auth"""
+        if analysis.biom and (not self._auth):
+            shared = publish_matrix(matrix_md5, analysis.biom)
+            if shared:
+                analysis._attach_mapped(shared)
+                analysis._shm_key = matrix_md5
+        return analysis
 
+    @instrument.timed('AnalysisSet.boxplot')
     def boxplot(self, annot='organism', level='domain', parent=None, width=300, height=300, title="", normalize=1, col_name=True, show_data=False, arg_list=False):
         if (self.method == 'Amplicon') and (annot == 'function'):
             sys.stderr.write("'%s' is an Amplicon dataset and contains no functional annotations\n"%self.defined_name)
@@ -157,6 +183,7 @@ class AnalysisSet(object):
         to_plot = getattr(self, level)
         return to_plot['abundance'].boxplot(**keyArgs)
     
+    @instrument.timed('AnalysisSet.barchart')
     def barchart(self, annot='organism', level='domain', parent=None, width=800, height=0, title="", legend=True, normalize=1, col_name=True, row_full=False, show_data=False, arg_list=False):
         if (self.method == 'Amplicon') and (annot == 'function'):
             sys.stderr.write("'%s' is an Amplicon dataset and contains no functional annotations\n"%self.defined_name)
@@ -188,6 +215,7 @@ class AnalysisSet(object):
         to_plot = getattr(self, level)
         return to_plot['abundance'].barchart(**keyArgs)
         
+    @instrument.timed('AnalysisSet.heatmap')
     def heatmap(self, annot='organism', level='domain', parent=None, width=700, height=600, normalize=1, dist='bray-curtis', clust='ward', col_name=True, row_full=False, show_data=False, arg_list=False):
         if (self.method == 'Amplicon') and (annot == 'function'):
             sys.stderr.write("'%s' is an Amplicon dataset and contains no functional annotations\n"%self.defined_name)
@@ -219,6 +247,7 @@ class AnalysisSet(object):
         to_plot = getattr(self, level)
         return to_plot['abundance'].heatmap(**keyArgs)
 
+    @instrument.timed('AnalysisSet.pco')
     def pco(self, annot='organism', level='domain', parent=None, width=700, height=600, title="", legend=True, normalize=1, dist='bray-curtis', x_axis=1, y_axis=2, col_name=True, show_data=False, arg_list=False):
         if (self.method == 'Amplicon') and (annot == 'function'):
             sys.stderr.write("'%s' is an Amplicon dataset and contains no functional annotations\n"%self.defined_name)
@@ -258,6 +287,30 @@ class AnalysisSet(object):
         else:
             return 'False'
 
+class _LazyMatrix(object):
+    """Analysis matrix attribute built on first use by calling the builder method, which sets all names of group"""
+    def __init__(self, name, builder, group):
+        self.name = name
+        self.builder = builder
+        self.group = group
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        store = obj.__dict__
+        if ('_'+self.name) not in store:
+            if self.name in store:
+                # object pickled before matrices were lazy
+                store['_'+self.name] = store.pop(self.name)
+            else:
+                for name in self.group:
+                    store.setdefault('_'+name, None)
+                getattr(obj, self.builder)()
+        return store['_'+self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__['_'+self.name] = value
+
 class Analysis(object):
     """Class representation of Matrix object:
         self.biom (BIOM format):
@@ -285,6 +338,8 @@ class Analysis(object):
         self.SRmatrix : R scaled matrix object (abundance sum)
         self.NDmatrix : normalized dense matrix
         self.NRmatrix : normalized R-format dense matrix
+        R, scaled and normalized matrices are built on first use. scaled and normalized matrices of a shared
+        matrix (see AnalysisSet) are shared too, as <md5>.scaled and <md5>.normalized in shmstore.
         
         Visualizations:
             self.dump()     : produce file or string of BIOM or tab-deliminated matrix
@@ -293,14 +348,21 @@ class Analysis(object):
             self.pco()      : pco plot of metagenomes
             self.heatmap()  : dendogram of metagenomes / annotations
     """
-    def __init__(self, ids=[], annotation=None, level=None, result_type=None, hit_type=None, source=None, e_val=None, ident=None, alen=None, filters=[], filter_source=None, filter_level=None, biom=None, bfile=None, auth=None, def_name=None):
+    Rmatrix  = _LazyMatrix('Rmatrix', '_build_rmatrix', ['Rmatrix'])
+    SDmatrix = _LazyMatrix('SDmatrix', '_build_scaled', ['SDmatrix', 'SRmatrix'])
+    SRmatrix = _LazyMatrix('SRmatrix', '_build_scaled', ['SDmatrix', 'SRmatrix'])
+    NDmatrix = _LazyMatrix('NDmatrix', '_build_normalized', ['NDmatrix', 'NRmatrix'])
+    NRmatrix = _LazyMatrix('NRmatrix', '_build_normalized', ['NDmatrix', 'NRmatrix'])
+
+    def __init__(self, ids=[], annotation=None, level=None, result_type=None, hit_type=None, source=None, e_val=None, ident=None, alen=None, filters=[], filter_source=None, filter_level=None, biom=None, bfile=None, mfile=None, auth=None, def_name=None):
         self._auth = auth
+        self._shm_key = None # shmstore md5 of this matrix if shared
         # hack to get variable name
         if def_name == None:
             (filename,line_number,function_name,text)=traceback.extract_stack()[-2]
             def_name = text[:text.find('=')].strip()
         self.defined_name = def_name
-        if (biom is None) and (bfile is None):
+        if (biom is None) and (bfile is None) and (mfile is None):
             self.biom = self._get_matrix(ids, annotation, level, result_type, hit_type, source, e_val, ident, alen, filters, filter_source, filter_level)
         elif biom and isinstance(biom, dict):
             self.biom = biom
@@ -311,10 +373,75 @@ class Analysis(object):
                 bhdl.close()
             except:
                 self.biom = None
+        elif mfile and os.path.isfile(mfile):
+            # memory-mapped matrix, 'data' is a read-only MappedMatrix
+            try:
+                self.biom = open_mapped(mfile)
+            except (IOError, ValueError) as e:
+                sys.stderr.write("Error loading %s: %s\n"%(mfile, e))
+                self.biom = None
         else:
             self.biom = None
         self._init_matrix()
 
+    def _attach_mapped(self, mfile):
+        """replace BIOM data and count matrix with the read-only memory-mapped copy in mfile"""
+        try:
+            biom = open_mapped(mfile)
+        except (IOError, ValueError) as e:
+            sys.stderr.write("Error loading %s: %s\n"%(mfile, e))
+            return
+        self.biom = biom
+        self.Dmatrix = biom['data']
+        self._reset_matrices()
+
+    def _reset_matrices(self):
+        for name in ('Rmatrix', 'SDmatrix', 'SRmatrix', 'NDmatrix', 'NRmatrix'):
+            self.__dict__.pop(name, None)
+            self.__dict__.pop('_'+name, None)
+
+    def _build_rmatrix(self):
+        self.Rmatrix = pyMatrix_to_rMatrix(self.Dmatrix, self.numAnnot, self.numIDs)
+
+    def _build_scaled(self):
+        if self.result_type != 'abundance':
+            return # only scale abundance counts
+        if not self._attach_derived('scaled', 'SDmatrix', 'SRmatrix', 0):
+            self._scale_matrix()
+            self._publish_derived('scaled', 'SDmatrix')
+
+    def _build_normalized(self):
+        if self.result_type != 'abundance':
+            return # only normalize abundance counts
+        if not self._attach_derived('normalized', 'NDmatrix', 'NRmatrix', 1):
+            self._normalize_matrix()
+            self._publish_derived('normalized', 'NDmatrix')
+
+    def _attach_derived(self, kind, dname, rname, normalize):
+        """set dname to shared <md5>.kind matrix and rname to its R matrix, False if not shared"""
+        key = getattr(self, '_shm_key', None)
+        shared = attach_matrix(key+'.'+kind) if key else None
+        if not shared:
+            return False
+        setattr(self, dname, shared['data'])
+        setattr(self, rname, pyMatrix_to_rMatrix(shared['data'], self.numAnnot, self.numIDs, normalize=normalize))
+        return True
+
+    def _publish_derived(self, kind, dname):
+        """publish dname as <md5>.kind for other kernels and switch to the shared copy"""
+        key = getattr(self, '_shm_key', None)
+        matrix = getattr(self, dname)
+        if (not key) or (not matrix):
+            return
+        biom = { 'id': self.id+'.'+kind, 'matrix_type': 'dense', 'shape': [len(matrix), len(matrix[0])], 'data': matrix }
+        shared = publish_matrix(key+'.'+kind, biom)
+        if shared:
+            try:
+                setattr(self, dname, open_mapped(shared)['data'])
+            except (IOError, ValueError) as e:
+                sys.stderr.write("Error loading %s: %s\n"%(shared, e))
+
+    @instrument.timed('Analysis.init_matrix')
     def _init_matrix(self):
         if (not self.biom) or (self.biom and ('id' not in self.biom) and ('data' not in self.biom)):
             sys.stderr.write("Error: Invalid BIOM object\n"+pprint.pformat(self.biom))
@@ -325,14 +452,8 @@ class Analysis(object):
         self.numIDs = self.biom['shape'][1] if self.biom else 0
         self.numAnnot = self.biom['shape'][0] if self.biom else 0
         self.Dmatrix  = self._dense_matrix()  # count dense matrix
-        self.Rmatrix  = pyMatrix_to_rMatrix(self.Dmatrix, self.numAnnot, self.numIDs) # R count matrix object
-        self.SDmatrix = None  # scaled dense matrix (abundance sum)
-        self.SRmatrix = None  # R scaled matrix object (abundance sum)
-        self.NDmatrix = None  # normalized dense matrix
-        self.NRmatrix = None  # R normalized matrix object
-        if self.result_type == 'abundance':
-            self._scale_matrix() # only scale abundance counts
-            self._normalize_matrix() # only normalize abundance counts
+        # R count matrix, scaled and normalized matrices are built on first use
+        self._reset_matrices()
         self.alpha_diversity = None
         self.rarefaction     = None
     
@@ -433,15 +554,17 @@ class Analysis(object):
         for i in rIndex:
             test = []
             rdata = []
+            drow = self.Dmatrix[i]
+            mrow = matrix[i]
             for j in cIndex:
-                test.append(self.Dmatrix[i][j])
-                val = matrix[i][j]
+                test.append(drow[j])
+                val = mrow[j]
                 # user inputted scaling
                 if scale and isinstance(scale, dict) and (all_mgids[j] in scale):
                     val = float(val) / scale[all_mgids[j]]
                 # output strings
                 if mark_zero:
-                    val = str(val) + ('*' if self.Dmatrix[i][j] == 0 else '')
+                    val = str(val) + ('*' if drow[j] == 0 else '')
                 rdata.append(val)
             # test if raw row is too small
             if sum(test) < row_min:
@@ -473,7 +596,7 @@ class Analysis(object):
             return None
         if fformat == 'biom':
             # biom dump
-            output = json.dumps(self.biom)
+            output = json.dumps(self.biom, default=lambda x: x.tolist()) # tolist for MappedMatrix data
         else:
             # get sub parts if not passed matrix, rows, cols:
             # this will validate that rows and cols are in biom and are ids, and that matrix has no all 0 slices
@@ -558,6 +681,7 @@ class Analysis(object):
         else:
             return self.biom['columns'][index]
     
+    @instrument.timed('Analysis.alpha_diversity')
     def alpha_diversity(self):
         if self.hierarchy != 'taxonomy':
             return None
@@ -578,6 +702,7 @@ class Analysis(object):
             self.alpha_diversity = alphaDiv
         return self.alpha_diversity
 
+    @instrument.timed('Analysis.rarefaction')
     def rarefaction(self):
         if self.hierarchy != 'taxonomy':
             return None
@@ -627,6 +752,7 @@ class Analysis(object):
         else:
             return 0
 
+    @instrument.timed('Analysis.boxplot')
     def boxplot(self, normalize=1, scale='auto', title='', width=300, height=300, cols=None, rows=None, col_name=True, show_data=False, arg_list=False, source='retina'):
         # default is all
         if (not cols) or (len(cols) == 0):
@@ -679,6 +805,7 @@ class Analysis(object):
             ro.r("dev.off()")
             return fname
 
+    @instrument.timed('Analysis.pco')
     def pco(self, normalize=1, scale='auto', title='', dist='bray-curtis', width=700, height=600, x_axis=1, y_axis=2, legend=True, cols=None, rows=None, col_name=True, show_data=False, arg_list=False, source='retina'):
         # default is all
         if (not cols) or (len(cols) == 0):
@@ -761,6 +888,7 @@ class Analysis(object):
             ro.r("dev.off()")
             return fname
 
+    @instrument.timed('Analysis.heatmap')
     def heatmap(self, normalize=1, scale='auto', title='', dist='bray-curtis', clust='ward', width=700, height=600, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None, source='retina'):
         if source == 'retina':
             return self._retina_heatmap(normalize=normalize, scale=scale, dist=dist, clust=clust, width=width, height=height, cols=cols, rows=rows, col_name=col_name, row_full=row_full, show_data=show_data, arg_list=arg_list, onclick=onclick)
@@ -838,6 +966,7 @@ class Analysis(object):
         ro.r("dev.off()")
         return fname
 
+    @instrument.timed('Analysis.barchart')
     def barchart(self, normalize=1, scale='auto', width=800, height=0, x_rotate='0', title="", legend=True, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None):
         # default is all
         all_mgids = self.ids()
@@ -909,7 +1038,7 @@ class Analysis(object):
 
     def _scale_matrix(self):
         try:
-            self.SDmatrix = relative_abundance_matrix(self.Dmatrix, self.ids)
+            self.SDmatrix = relative_abundance_matrix(self.Dmatrix, self.ids())
             self.SRmatrix = pyMatrix_to_rMatrix(self.SDmatrix, self.numAnnot, self.numIDs)
         except:
             sys.stderr.write("Error scaling matrix to adundance sum (%s)\n"%self.id)
@@ -925,7 +1054,7 @@ class Analysis(object):
         except:
             # do it ourselves
             try:
-                self.NDmatrix = scale_matrix( normalize_matrix(log_transform_matrix(self.Dmatrix), self.ids) )
+                self.NDmatrix = scale_matrix( normalize_matrix(log_transform_matrix(self.Dmatrix), self.ids()) )
                 self.NRmatrix = pyMatrix_to_rMatrix(self.NDmatrix, self.numAnnot, self.numIDs, normalize=1)
             except:
                 sys.stderr.write("Error normalizing matrix (%s)\n"%self.id)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the matrix, normalization and clustering code paths.
+
+Each case runs in a forked child process on a synthetic BIOM fixture, so peak memory is measured per case.
+Results can be saved as a baseline json file, later runs are compared to it and regressions flagged.
+
+    python benchmark.py --sizes small,medium --save baseline.json
+    python benchmark.py --sizes small,medium --baseline baseline.json
+"""
+
+import sys, os, random, resource, copy, argparse, tempfile, shutil
+from ipyTools import *
+from analysis import Analysis
+
+# name : (rows, columns, density)
+SIZES = { 'tiny':   (10, 10, 0.5),
+          'small':  (1000, 20, 0.2),
+          'medium': (10000, 100, 0.1),
+          'large':  (100000, 1000, 0.01) }
+
+CASES = [ 'sparse_to_dense', 'init_matrix', 'sub_matrix', 'relative_abundance_matrix', 'normalize_matrix',
+          'merge_biom', 'biom_remove_empty', 'rarefaction', 'alpha_diversity', 'heatmap', 'pcoa' ]
+
+def synthetic_biom(rows, cols, density=0.1, seed=0, prefix='mgm'):
+    """returns sparse taxonomy abundance BIOM object of given shape, about density of cells are non-zero.
+    same arguments always give the same object"""
+    rand = random.Random(seed)
+    data = []
+    for r in xrange(rows):
+        for c in xrange(cols):
+            if rand.random() < density:
+                data.append([r, c, rand.randint(1, 1000)])
+    return { 'id': '%s_%dx%d_%d'%(prefix, rows, cols, seed),
+             'format': 'Biological Observation Matrix 1.0',
+             'format_url': 'http://biom-format.org',
+             'type': 'Taxon table',
+             'generated_by': 'ipyMKMQ benchmark',
+             'date': '2000-01-01T00:00:00',
+             'matrix_type': 'sparse',
+             'matrix_element_type': 'int',
+             'matrix_element_value': 'abundance',
+             'shape': [rows, cols],
+             'rows': [ {'id': 'taxa_%d'%r, 'metadata': {'taxonomy': ['d_%d'%(r%3), 'p_%d'%(r%17), 'taxa_%d'%r]}} for r in xrange(rows) ],
+             'columns': [ {'id': '%s%d.3'%(prefix, c), 'name': 'sample %d'%c, 'metadata': None} for c in xrange(cols) ],
+             'data': data }
+
+class _FixtureMetagenome(object):
+    """stands in for Metagenome in rarefaction, which otherwise fetches every metagenome through the API"""
+    def __init__(self, nseq):
+        self.name = 'fixture'
+        self.statistics = {'sequence_count_raw': nseq, 'rarefaction': []}
+
+class _FixtureAnalysis(Analysis):
+    def get_id_object(self, aid):
+        return _FixtureMetagenome( sum(slice_column(self.Dmatrix, self.ids().index(aid))) )
+
+def _built(analysis):
+    """build the lazy R, scaled and normalized matrices of analysis, returns it"""
+    for name in ('Rmatrix', 'SDmatrix', 'NDmatrix'):
+        getattr(analysis, name)
+    return analysis
+
+def _setup(case, biom):
+    """returns (prepare, run): prepare() builds fresh input outside the timing, run(input) is timed.
+    R is loaded outside the timing, cases using R, scaled or normalized matrices get them built in prepare(),
+    init_matrix times building them"""
+    dense = lambda: sparse_to_dense(biom['data'], biom['shape'][0], biom['shape'][1])
+    fixture = lambda: _FixtureAnalysis(biom=copy.deepcopy(biom), def_name='bench')
+    cols  = map(lambda x: x['id'], biom['columns'])
+    if case == 'sparse_to_dense':
+        return lambda: biom, lambda b: sparse_to_dense(b['data'], b['shape'][0], b['shape'][1])
+    if case == 'init_matrix':
+        ro.load()
+        def init(a):
+            a._init_matrix()
+            return _built(a)
+        return fixture, init
+    if case == 'sub_matrix':
+        return lambda: _built(fixture()), lambda a: a.sub_matrix()
+    if case == 'relative_abundance_matrix':
+        return dense, lambda m: relative_abundance_matrix(m, cols)
+    if case == 'normalize_matrix':
+        return dense, lambda m: normalize_matrix(m, cols)
+    if case == 'merge_biom':
+        other = synthetic_biom(biom['shape'][0], biom['shape'][1], 0.1, seed=1, prefix='mgx')
+        return lambda: (copy.deepcopy(biom), copy.deepcopy(other)), lambda x: merge_biom(x[0], x[1])
+    if case == 'biom_remove_empty':
+        return lambda: copy.deepcopy(biom), biom_remove_empty
+    if case in ('rarefaction', 'alpha_diversity'):
+        def prepare():
+            a = fixture()
+            setattr(a, case, None)
+            return a
+        return prepare, lambda a: getattr(Analysis, case)(a)
+    if case == 'heatmap':
+        ro.load()
+        return lambda: _built(fixture()), lambda a: a._retina_heatmap(arg_list=True)
+    if case == 'pcoa':
+        ro.load()
+        return lambda: _built(fixture()), lambda a: a.pco(arg_list=True)
+    raise ValueError("unknown benchmark case '%s'"%case)
+
+def _maxrss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+def _forked(func):
+    """run func in a forked child, returns its json-able result"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        random.seed()
+        try:
+            out = func()
+        except Exception as e:
+            out = {'error': '%s: %s'%(e.__class__.__name__, e)}
+        os.write(wfd, json.dumps(out))
+        os._exit(0)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(data)) if data else {'error': 'benchmark process died'}
+
+def run_case(case, size, repeat=3):
+    """time one case at one size, returns { 'seconds': best wall time, 'peak_kb': peak memory increase while timed }.
+    the peak baseline is taken after the first prepare(), so input construction is not counted"""
+    rows, cols, density = SIZES[size]
+    def measure():
+        prepare, func = _setup(case, synthetic_biom(rows, cols, density))
+        best = None
+        base = None
+        for i in xrange(repeat):
+            item = None # free the previous input before building the next
+            item = prepare()
+            if base is None:
+                base = _maxrss_kb()
+            stime = time()
+            func(item)
+            secs  = time() - stime
+            best  = secs if (best is None) else min(best, secs)
+        return {'seconds': best, 'peak_kb': _maxrss_kb() - base}
+    return _forked(measure)
+
+def run(sizes=['tiny', 'small'], cases=CASES, repeat=3, baseline=None, tolerance=0.25):
+    """run cases for sizes, returns { size : { case : result } }.
+    if baseline (results dict or json file), results slower or larger than baseline by more than tolerance
+    get 'regression': list of 'seconds' / 'peak_kb', cases that ran in the baseline and now fail get ['error']"""
+    if baseline and isinstance(baseline, basestring):
+        baseline = json.load(open(baseline, 'rU'))
+    results = {}
+    for size in sizes:
+        results[size] = {}
+        for case in cases:
+            res = run_case(case, size, repeat)
+            prev = (baseline or {}).get(size, {}).get(case)
+            if prev and ('error' in res) and ('error' not in prev):
+                res['regression'] = ['error']
+            elif prev and ('error' not in res) and ('error' not in prev):
+                # ignore differences below timer / page noise
+                slow = [ k for k, noise in (('seconds', 0.001), ('peak_kb', 1024)) if (res[k] > (prev[k] * (1 + tolerance))) and ((res[k] - prev[k]) > noise) ]
+                if slow:
+                    res['regression'] = slow
+                res['baseline'] = prev['seconds']
+            results[size][case] = res
+    return results
+
+def report(results):
+    """returns text table of results"""
+    lines = [ "\t".join(['size', 'case', 'seconds', 'peak_kb', 'baseline', 'status']) ]
+    for size in sorted(results.keys(), key=lambda x: SIZES[x][0] * SIZES[x][1]):
+        for case in CASES:
+            res = results[size].get(case)
+            if res is None:
+                continue
+            if 'error' in res:
+                status = ('REGRESSION: ' if res.get('regression') else '') + res['error']
+                lines.append("\t".join([size, case, '', '', '', status]))
+                continue
+            status = 'REGRESSION: '+','.join(res['regression']) if res.get('regression') else 'ok'
+            base = '%.4f'%res['baseline'] if 'baseline' in res else ''
+            lines.append("\t".join([size, case, '%.4f'%res['seconds'], str(res['peak_kb']), base, status]))
+    return "\n".join(lines)
+
+def save_baseline(results, fname):
+    clean = dict([(s, dict([(c, dict([(k, v) for k, v in r.iteritems() if k in ('seconds', 'peak_kb', 'error')])) for c, r in cases.iteritems()])) for s, cases in results.iteritems()])
+    json.dump(clean, open(fname, 'w'), indent=1, sort_keys=True)
+    return fname
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark matrix, normalization and clustering code paths")
+    parser.add_argument('--sizes', default='tiny,small', help="comma separated sizes: "+", ".join(sorted(SIZES.keys())))
+    parser.add_argument('--cases', default=",".join(CASES), help="comma separated cases")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case, best time is kept")
+    parser.add_argument('--baseline', default=None, help="baseline json file to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown before flagging regression")
+    parser.add_argument('--save', default=None, help="save results as baseline json file")
+    parser.add_argument('--lib', default=None, help="directory of the R scripts (dendrogram.r, plot_pco.r), default ./lib")
+    args = parser.parse_args()
+    # temp and cache files go to a scratch notebook dir, removed when done
+    nb_dir = tempfile.mkdtemp(prefix='ipymkmq_bench.')
+    try:
+        init_ipy(nb_dir=nb_dir)
+        Ipy.LIB_DIR = args.lib if args.lib else os.path.join(os.getcwd(), 'lib')
+        results = run(args.sizes.split(','), args.cases.split(','), args.repeat, args.baseline, args.tolerance)
+    finally:
+        shutil.rmtree(nb_dir, True)
+    print report(results)
+    if args.save:
+        save_baseline(results, args.save)
+    sys.exit(1 if any(r.get('regression') for s in results.itervalues() for r in s.itervalues()) else 0)
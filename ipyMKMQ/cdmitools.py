@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import sys, os
+from time import time
+from ipyTools import *
+from rpc import RPCClient
+
+def iter_entities(api, entity, fields=[], page_size=1000, max_page_size=50000, target=5, prefetch=True):
+    """Generator over all entities of a type from CDMI all_entities_<entity>, yields (id, {field: value}).
+    api is a cdmi.CDMI_EntityAPI or rpc.RPCClient wrapping one.
+    page size starts at page_size and adapts: doubles while pages take under 'target' seconds, up to max_page_size,
+    halves when slower. if prefetch the next page is fetched concurrently while the current one is consumed.
+    iteration ends on an empty page, the server may return fewer entities than asked for (ie. a size cap).
+    """
+    func  = getattr(api, 'all_entities_'+entity)
+    state = {'size': page_size}
+    def fetch(start, count):
+        stime = time()
+        page = func(start, count, fields)
+        return page, count, time() - stime
+    start = 0
+    pending = fetch(start, state['size'])
+    while True:
+        if prefetch and hasattr(pending, 'get'):
+            pending = pending.get()
+        page, count, secs = pending
+        if not page:
+            break
+        # adapt page size
+        if secs < target:
+            state['size'] = min(state['size'] * 2, max_page_size)
+        elif secs > target * 2:
+            state['size'] = max(state['size'] / 2, 1)
+        start += len(page)
+        pending = apply_concurrent(fetch, start, state['size']) if prefetch else fetch(start, state['size'])
+        for eid in sorted(page.iterkeys()):
+            yield eid, page[eid]
+
+def iter_query(api, entity, qry, fields=[], page_limit=None):
+    """Generator over results of CDMI query_entity_<entity>(qry, fields), yields (id, {field: value}) in id order.
+    if the server caps results at page_limit, queries are repeated with ['id', '>', last id] added until exhausted.
+    """
+    func = getattr(api, 'query_entity_'+entity)
+    last = None
+    while True:
+        page = func(qry + ([['id', '>', last]] if last is not None else []), fields)
+        if not page:
+            break
+        for eid in sorted(page.iterkeys()):
+            yield eid, page[eid]
+        last = max(page.iterkeys())
+        if (not page_limit) or (len(page) < page_limit):
+            break
+
+class Traversal(object):
+    """Multi-hop traversal over CDMI get_relationship_<name> calls:
+        run(ids, path) : follow list of relationship names from ids,
+                         ie. ['IsComposedOf', 'IsLocusFor', 'HasFunctional'] for genome -> contig -> feature -> role
+                         returns { start id : set of ids reached at end of path }
+        hop(name, ids) : one hop, returns { id : set of linked ids }
+    at each hop ids are deduplicated, split into chunks sent concurrently (batched if the server allows),
+    and edges already seen are memoized in self.edges: { relationship : { from id : set of to ids } }
+    """
+    def __init__(self, api, chunk_size=500):
+        self.api = api if isinstance(api, RPCClient) else RPCClient(api, chunk_size=chunk_size)
+        self.edges = {}
+
+    def hop(self, relationship, ids):
+        memo = self.edges.setdefault(relationship, {})
+        ids  = set(ids)
+        todo = sorted(filter(lambda x: x not in memo, ids))
+        if todo:
+            if Ipy.DEBUG:
+                sys.stdout.write("%s: %d ids (%d cached)\n"%(relationship, len(todo), len(ids) - len(todo)))
+            links = self.api.scatter('get_relationship_'+relationship, todo, [], ['from_link', 'to_link'], [])
+            for i in todo:
+                memo[i] = set()
+            for link in links:
+                rel = link[1]
+                memo.setdefault(rel['from_link'], set()).add(rel['to_link'])
+        return dict([(i, memo.get(i, set())) for i in ids])
+
+    def run(self, ids, path):
+        reach = dict([(i, set([i])) for i in ids])
+        for relationship in path:
+            frontier = set()
+            for curr in reach.itervalues():
+                frontier.update(curr)
+            edges = self.hop(relationship, frontier)
+            for start, curr in reach.iteritems():
+                found = set()
+                for i in curr:
+                    found.update(edges[i])
+                reach[start] = found
+        return reach
+
+def entities_to_file(entities, fields, fname):
+    """write (id, {field: value}) pairs from iter_entities / iter_query to tab-deliminated file,
+    one column per field, streaming so memory use is constant. returns row count"""
+    count = 0
+    fhdl = open(fname, 'w')
+    fhdl.write("\t".join(['id'] + fields) + "\n")
+    for eid, data in entities:
+        row = [eid] + map(lambda x: _field_str(data.get(x)), fields)
+        fhdl.write("\t".join(map(lambda x: unicode(x).encode('utf-8'), row)) + "\n")
+        count += 1
+    fhdl.close()
+    return count
+
+def entities_to_columns(entities, fields, out_dir):
+    """write (id, {field: value}) pairs from iter_entities / iter_query as columns: one file out_dir/<field>.col
+    per field (and id.col), one value per line, all in the same row order. streaming, memory use is constant.
+    read_columns loads only the fields asked for. returns row count"""
+    names = ['id'] + filter(lambda x: x != 'id', fields)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    hdls = map(lambda x: open(os.path.join(out_dir, x+'.col'), 'w'), names)
+    count = 0
+    try:
+        for eid, data in entities:
+            for name, fhdl in zip(names, hdls):
+                val = eid if name == 'id' else _field_str(data.get(name))
+                fhdl.write(unicode(val).encode('utf-8') + "\n")
+            count += 1
+    finally:
+        for fhdl in hdls:
+            fhdl.close()
+    return count
+
+def read_columns(out_dir, fields):
+    """returns { field : list of values } of the columns written by entities_to_columns, '' for missing values"""
+    cols = {}
+    for name in fields:
+        fhdl = open(os.path.join(out_dir, name+'.col'), 'rU')
+        cols[name] = map(lambda x: x.rstrip("\n").decode('utf-8'), fhdl)
+        fhdl.close()
+    return cols
+
+def _field_str(val):
+    if val is None:
+        return ''
+    if isinstance(val, list):
+        return ','.join(map(unicode, val))
+    return ' '.join(unicode(val).split())
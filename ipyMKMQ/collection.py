@@ -3,11 +3,12 @@
 import sys, os, hashlib, traceback
 from collections import defaultdict
 import IPython.core.display
-from metagenome import Metagenome
+from metagenome import Metagenome, load_metagenomes, display_mg_data
+from metadata import MetadataIndex, MetadataTable
 from ipyTools import *
 from qc import Rarefaction
 
-def get_collection(mgids=[], auth=None, def_name=None):
+def get_collection(mgids=[], auth=None, lazy=False, def_name=None):
     """Wrapper for Collection object creation, checks if cache (created through unique option set) exists first and returns that.
     
     see: help(Collection)
@@ -27,7 +28,7 @@ def get_collection(mgids=[], auth=None, def_name=None):
             (filename,line_number,function_name,text)=traceback.extract_stack()[-2]
             def_name = text[:text.find('=')].strip()
         print "Loading Collection for selected metagenomes through API. Please wait, this may take several minutes ..."
-        new_obj = Collection(mgids=mgids, auth=auth, def_name=def_name)
+        new_obj = Collection(mgids=mgids, auth=auth, def_name=def_name, lazy=lazy)
         save_object(new_obj, cache_md5)
         print "Done loading through API"
         return new_obj
@@ -38,11 +39,14 @@ class Collection(object):
         rarefaction : Rarefaction object for collection metagenomes
         _mgids      : [ 'list', 'inputted metagenome ids' ]
         display     : 'CollectionDisplay Object - help(this_name.display)'
+    
+    lazy=True loads only metagenome metadata, statistics are fetched per metagenome on first use.
         
     see: help(Metagenome)
     """
-    def __init__(self, mgids=[], auth=None, def_name=None, cache=False):
+    def __init__(self, mgids=[], auth=None, def_name=None, cache=False, lazy=False):
         self._auth  = auth
+        self._lazy  = lazy
         self._mgids = mgids
         # hack to get variable name
         if def_name == None:
@@ -54,19 +58,16 @@ class Collection(object):
         self.defined_name = def_name
         # set display
         self.display = CollectionDisplay(def_name=self.defined_name+'.display')
-        # get metagenomes
+        # get metagenomes / index metadata
+        self._md_index = MetadataIndex()
         self.metagenomes = self._get_metagenomes(cache)
         self.display._populate_collection()
     
+    @instrument.timed('Collection.load')
     def _get_metagenomes(self, cache):
-        mgs = {}
+        mgs = load_metagenomes(self._mgids, auth=self._auth, cache=cache, lazy=self._lazy, def_name=self.defined_name+'.metagenomes')
         for mg in self._mgids:
-            keyArgs = { 'auth': self._auth,
-                        'cache': cache,
-                        'display': False,
-                        'def_name': '%s.metagenomes["%s"]'%(self.defined_name, mg)
-                       }
-            mgs[mg] = Metagenome(mg, **keyArgs)
+            self._md_index.add(mgs[mg])
             # add mg to display
             if self.display:
                 self.display._add_mg(mgs[mg])
@@ -91,17 +92,24 @@ class Collection(object):
                 stat_list.append( toNum(self.metagenomes[m].statistics['sequence_stats'][stat]) )
         return stat_list
 
+    def _metadata_index(self):
+        # build index if missing, ie. collection loaded from older pickled object
+        if getattr(self, '_md_index', None) is None:
+            self._md_index = MetadataIndex(self.metagenomes.values())
+        return self._md_index
+
+    def metadata_table(self):
+        """returns MetadataTable of collection metagenomes (one typed column per category / field)"""
+        mgs = map(lambda x: self.metagenomes[x], filter(lambda y: y in self.metagenomes, self._mgids))
+        table = getattr(self, '_md_table', None)
+        if (table is None) or (table.mgids != map(lambda x: x.id, mgs)):
+            table = MetadataTable(mgs)
+            self._md_table = table
+        return table
+
     def metadata_fields(self, table=True):
             tdata = []
-            mdata = dict([(x, set()) for x in Ipy.MD_CATS])
-            for mg in self.metagenomes.itervalues():
-                if not hasattr(mg, 'metadata'):
-                    continue
-                for cat in Ipy.MD_CATS:
-                    if cat not in mg.metadata:
-                        continue
-                    for key in mg.metadata[cat]['data'].iterkeys():
-                        mdata[cat].add(key)
+            mdata = dict([(c, set(f)) for c, f in self._metadata_index().fields.iteritems()])
             if not table:
                 return mdata
             for cat in mdata.iterkeys():
@@ -119,26 +127,22 @@ class Collection(object):
             except:
                 sys.stderr.write("Error producing metadata table\n")
     
-    def search_metadata(self, category=None, field=None, value=None):
-        sub_mgs = set()
-        all_fields = []
-        for f in self.metadata_fields(table=False).itervalues():
-            all_fields.extend(list(f))
+    def search_metadata(self, category=None, field=None, value=None, match='substring', min_value=None, max_value=None):
+        """return list of metagenome ids whose metadata category / field matches value,
+        match is one of 'substring' (default), 'exact' or 'prefix'.
+        if min_value and / or max_value are given, returns those with numeric value in range instead.
+        """
+        index  = self._metadata_index()
+        ranged = (min_value is not None) or (max_value is not None)
         if not (category and (category in Ipy.MD_CATS)):
             sys.stderr.write("category must be one of: %s\n"%", ".join(Ipy.MD_CATS))
             return self.mgids()
-        if not (field and value and (field in all_fields)):
+        if not (field and (value or ranged) and index.has_field(field)):
             sys.stderr.write("field '%s' does not exist\n"%field)
             return self.mgids()
-        for mid, mg in self.metagenomes.iteritems():
-            if not (hasattr(mg, 'metadata') and (category in mg.metadata)):
-                continue
-            for key, val in mg.metadata[category]['data'].iteritems():
-                if key == field:
-                    x = str(val).find(value)
-                    if x != -1:
-                        sub_mgs.add(mid)
-        return list(sub_mgs)
+        if ranged:
+            return list(index.search_range(category, field, min_value, max_value))
+        return list(index.search(category, field, value, match=match))
 
 class CollectionDisplay(object):
     """Class containing functions to display metagenome collection visualizations:
@@ -163,14 +167,12 @@ class CollectionDisplay(object):
             except:
                 pass
         self.defined_name = def_name
-        # load and create instance of metagenome widget
+        # load and create instance of collection widget, data is sent per view
         self._col_widget = 'window.col_widget_'+random_str();
         self._widget_div = 'col_div_'+random_str();
-        self._tmp_mgs = 'window.'+random_str();
         html = "<div id='%s'></div>"%self._widget_div
         src = """
         (function() {
-            """+self._tmp_mgs+""" = [];
             Retina.load_widget("collection_overview").then( function() {
                 """+self._col_widget+""" = Retina.Widget.create('collection_overview', {'target': document.getElementById('"""+self._widget_div+"""')}, true);
             });
@@ -183,23 +185,23 @@ class CollectionDisplay(object):
         
     def _add_mg(self, mg):
         self.mgs.append(mg)
-        func = """
-        (function() {
-            """+self._tmp_mgs+""".push("""+json.dumps( mg._mg_dict() )+""");
-        })();
-        """
-        IPython.core.display.display_javascript(IPython.core.display.Javascript(data=func))
 
     def _populate_collection(self):
+        display_mg_data(self.mgs)
         func = """
         (function() {
-            setTimeout(function() {
-                """+self._col_widget+""".curr_mgs = """+self._tmp_mgs+""";
-            },1000);
+            setTimeout(function() { window.ipy_mg_when(function() {
+                """+self._col_widget+""".curr_mgs = """+json.dumps(map(lambda x: x.id, self.mgs))+""".map(function(id) { return window.ipy_mg_data[id]; });
+            }); },1000);
         })();
         """
         IPython.core.display.display_javascript(IPython.core.display.Javascript(data=func))
 
+    def _send_view_data(self, view):
+        # send only data of displayed metagenomes needed for view
+        mgs = filter(lambda x: x.id in self._display_ids, self.mgs) if self._display_ids else self.mgs
+        display_mg_data(mgs, view)
+
     def set_display_mgs(self, ids=[]):
         display_ids = []
         if ids:
@@ -276,48 +278,56 @@ class CollectionDisplay(object):
         
     def summary_chart(self, arg_list=False, target=None):
         try:
+            self._send_view_data('summary_chart')
             Ipy.RETINA.collection(widget=self._col_widget, view='summary_chart', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing summary chart\n")
 
     def summary_stats(self, arg_list=False, target=None):
         try:
+            self._send_view_data('summary_stats')
             Ipy.RETINA.collection(widget=self._col_widget, view='summary_stats', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing summary stats\n")
             
     def annotation_chart(self, annotation='organism', level='domain', source='Subsystems', arg_list=False, target=None):
         try:
+            self._send_view_data('annotation_chart')
             Ipy.RETINA.collection(widget=self._col_widget, view='annotation_chart', annotation=annotation, level=level, source=source, arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing annotation chart\n")
             
     def drisee(self, arg_list=False, target=None):
         try:
+            self._send_view_data('drisee')
             Ipy.RETINA.collection(widget=self._col_widget, view='drisee', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing drisee plot\n")
             
     def kmer(self, kmer='abundance', arg_list=False, target=None):
         try:
+            self._send_view_data('kmer')
             Ipy.RETINA.collection(widget=self._col_widget, view='kmer', kmer=kmer, arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing kmer plot\n")
             
     def rarefaction(self, arg_list=False, target=None):
         try:
+            self._send_view_data('rarefaction')
             Ipy.RETINA.collection(widget=self._col_widget, view='rarefaction', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing rarefaction plot\n")
             
     def mixs(self, arg_list=False, target=None):
         try:
+            self._send_view_data('mixs')
             Ipy.RETINA.collection(widget=self._col_widget, view='mixs', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing mixs metadata table\n")
             
     def metadata(self, arg_list=False, target=None):
         try:
+            self._send_view_data('metadata')
             Ipy.RETINA.collection(widget=self._col_widget, view='metadata', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing full metadata table\n")
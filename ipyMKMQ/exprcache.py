@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import sys
+from ipyTools import *
+import expression
+
+class ExpressionMatrix(object):
+    """Compact samples x genes matrix of expression levels:
+        samples : list of sample ids, row order
+        genes   : list of gene ids, column order
+        rows    : list of array('d') per sample, NaN where no level
+        loaded  : list of array('b') per sample, 1 where the cell was fetched from the service
+    sample_index / gene_index map ids to row / column numbers.
+    """
+    def __init__(self):
+        self.samples = []
+        self.genes   = []
+        self.rows    = []
+        self.loaded  = []
+        self.sample_index = {}
+        self.gene_index   = {}
+
+    def _add_ids(self, sample_ids, gene_ids):
+        for g in gene_ids:
+            if g not in self.gene_index:
+                self.gene_index[g] = len(self.genes)
+                self.genes.append(g)
+                for i in xrange(len(self.rows)):
+                    self.rows[i].append(float('nan'))
+                    self.loaded[i].append(0)
+        for s in sample_ids:
+            if s not in self.sample_index:
+                self.sample_index[s] = len(self.samples)
+                self.samples.append(s)
+                self.rows.append(array.array('d', [float('nan')] * len(self.genes)))
+                self.loaded.append(array.array('b', [0] * len(self.genes)))
+
+    def add(self, sample_ids, gene_ids, levels):
+        """add get_experiments_by_sampleid_geneid(sample_ids, gene_ids) result: { sample id : { gene id : level } }"""
+        self._add_ids(sample_ids, gene_ids)
+        cols = map(lambda x: self.gene_index[x], gene_ids)
+        for s in sample_ids:
+            r = self.sample_index[s]
+            for c in cols:
+                self.loaded[r][c] = 1
+            for g, val in (levels.get(s) or {}).iteritems():
+                if g in self.gene_index:
+                    self.rows[r][self.gene_index[g]] = toNum(val)
+
+    def missing(self, sample_ids, gene_ids):
+        """returns list of (sample ids, gene ids) requests covering all cells not yet fetched"""
+        new_samples = filter(lambda x: x not in self.sample_index, sample_ids)
+        old_samples = filter(lambda x: x in self.sample_index, sample_ids)
+        todo = []
+        if new_samples:
+            todo.append((new_samples, gene_ids))
+        genes = []
+        for g in gene_ids:
+            c = self.gene_index.get(g)
+            if (c is None) or any(self.loaded[self.sample_index[s]][c] == 0 for s in old_samples):
+                genes.append(g)
+        if old_samples and genes:
+            todo.append((old_samples, genes))
+        return todo
+
+    def slice(self, sample_ids=None, gene_ids=None):
+        """returns list of rows (list of levels, None where missing) for sample_ids x gene_ids, default all"""
+        if sample_ids is None:
+            sample_ids = self.samples
+        if gene_ids is None:
+            gene_ids = self.genes
+        cols = map(lambda x: self.gene_index.get(x), gene_ids)
+        data = []
+        for s in sample_ids:
+            r = self.sample_index.get(s)
+            row = self.rows[r] if r is not None else None
+            data.append(map(lambda c: None if (row is None) or (c is None) or (row[c] != row[c]) else row[c], cols))
+        return data
+
+    def row(self, sample_id):
+        return self.slice([sample_id])[0]
+
+    def column(self, gene_id):
+        return map(lambda x: x[0], self.slice(None, [gene_id]))
+
+class ExpressionCache(object):
+    """Cached PlantExpression lookups:
+        vocabulary(kind)         : get_all_po / get_all_eo result, kind 'po' or 'eo'
+        descriptions(kind, ids)  : get_po_descriptions / get_eo_descriptions, only uncached ids are requested
+        levels(sample_ids, gene_ids) : rows of levels from self.matrix (ExpressionMatrix),
+                                       only cells not fetched before are requested
+    vocabularies and descriptions are saved to Ipy.CCH_DIR/expression_vocab.json (created if missing) and loaded again on creation.
+    """
+    def __init__(self, api=None, fname=None):
+        self.api = api if api else expression.PlantExpression(Ipy.EXPRESSION_URL)
+        self.fname = fname if fname else Ipy.CCH_DIR+'/expression_vocab.json'
+        self.vocab = {}
+        self.descs = {'po': {}, 'eo': {}}
+        self.matrix = ExpressionMatrix()
+        if os.path.isfile(self.fname):
+            data = json.load(open(self.fname, 'rU'))
+            self.vocab = data.get('vocab', {})
+            self.descs.update(data.get('descs', {}))
+
+    def save(self):
+        """returns file name, None if not written (lookups keep their results)"""
+        return write_cache(self.fname, {'vocab': self.vocab, 'descs': self.descs})
+
+    def vocabulary(self, kind='po'):
+        if kind not in self.vocab:
+            self.vocab[kind] = getattr(self.api, 'get_all_'+kind)()
+            self.save()
+        return self.vocab[kind]
+
+    def descriptions(self, kind, ids):
+        cache = self.descs[kind]
+        missing = sorted(filter(lambda x: x not in cache, set(ids)))
+        if missing:
+            found = getattr(self.api, 'get_%s_descriptions'%kind)(missing) or {}
+            for i in missing:
+                cache[i] = found.get(i)
+            self.save()
+        return dict([(i, cache[i]) for i in ids])
+
+    def levels(self, sample_ids, gene_ids):
+        todo = self.matrix.missing(sample_ids, gene_ids)
+        if Ipy.DEBUG:
+            for samples, genes in todo:
+                sys.stdout.write("fetching %d samples x %d genes\n"%(len(samples), len(genes)))
+        found = map_concurrent(lambda x: self.api.get_experiments_by_sampleid_geneid(x[0], x[1]), todo)
+        for (samples, genes), levels in zip(todo, found):
+            self.matrix.add(samples, genes, levels)
+        return self.matrix.slice(sample_ids, gene_ids)
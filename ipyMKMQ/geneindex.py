@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import sys, re, bisect
+from ipyTools import *
+import cdmi
+from rpc import RPCClient
+
+_INDEXES = {} # genome id : GeneIndex
+
+def get_gene_index(genome_id, api=None, functions=True):
+    """returns GeneIndex for genome, loaded once per session: from cache file if it exists, else built through CDMI"""
+    if genome_id not in _INDEXES:
+        _INDEXES[genome_id] = GeneIndex(genome_id, api=api, functions=functions)
+    return _INDEXES[genome_id]
+
+def _natural_key(text):
+    return map(lambda x: int(x) if x.isdigit() else x, re.split(r'(\d+)', text))
+
+class GeneIndex(object):
+    """Local interval index of gene coordinates for one genome, answers gene window questions of
+    Genotype_PhenotypeAPI (traits_to_genes, variations_to_genes, selected_locations_to_genes) without the service.
+
+    genes are loaded once from Ipy.CCH_DIR/<genome_id>.genes.json, or from CDMI genomes_to_fids / fids_to_locations
+    (and fids_to_functions) which is then written to that file if possible. per contig genes are kept sorted by start:
+        contigs : { contig id : [ starts, ends, fids ] }
+        contig_ids : sorted contig ids, chromosome index i of a variation is contig_ids[i]
+    results are { 'genes': [ [contig, fid, start, end, function], ... ] }, genes sorted by contig and start.
+    """
+    def __init__(self, genome_id=None, api=None, functions=True, fname=None):
+        self.genome_id = genome_id
+        self.contigs   = {}
+        self.functions = {}
+        self.max_len   = {}
+        self.contig_ids = []
+        if not genome_id:
+            return
+        if not fname:
+            fname = Ipy.CCH_DIR+'/'+genome_id+'.genes.json'
+        if os.path.isfile(fname):
+            data = json.load(open(fname, 'rU'))
+        else:
+            data = self._fetch(api, functions)
+            write_cache(fname, data) # a failed write keeps the fetched genes
+        self.functions = data.get('functions', {})
+        self.add(data['genes'])
+
+    def _fetch(self, api, functions):
+        if api is None:
+            api = cdmi.CDMI_API(Ipy.CDMI_URL)
+        rpc  = api if isinstance(api, RPCClient) else RPCClient(api)
+        fids = rpc.genomes_to_fids([self.genome_id], ['CDS', 'locus']).get(self.genome_id, [])
+        locs = rpc.scatter('fids_to_locations', fids) if fids else {}
+        genes = []
+        for fid, regions in locs.iteritems():
+            if not regions:
+                continue
+            # regions are [contig, begin, strand, length], begin is right end on '-' strand
+            spans = map(lambda r: (r[1], r[1]+r[3]-1) if r[2] == '+' else (r[1]-r[3]+1, r[1]), regions)
+            genes.append([regions[0][0], fid, min(map(lambda x: x[0], spans)), max(map(lambda x: x[1], spans))])
+        funcs = rpc.scatter('fids_to_functions', map(lambda x: x[1], genes)) if functions and genes else {}
+        return {'genes': genes, 'functions': funcs}
+
+    def add(self, genes):
+        """add list of [contig, fid, start, end] to index"""
+        raw = {}
+        for contig, fid, start, end in genes:
+            raw.setdefault(contig, []).append((start, end, fid))
+        for contig, curr in raw.iteritems():
+            if contig in self.contigs:
+                starts, ends, fids = self.contigs[contig]
+                curr.extend(zip(starts, ends, fids))
+            curr.sort()
+            self.contigs[contig] = [ array.array('l', map(lambda x: x[0], curr)),
+                                     array.array('l', map(lambda x: x[1], curr)),
+                                     map(lambda x: x[2], curr) ]
+            self.max_len[contig] = max(map(lambda x: x[1] - x[0], curr))
+        self.contig_ids = sorted(self.contigs.keys(), key=_natural_key)
+
+    def contig(self, chrom):
+        """contig id from contig id or chromosome index"""
+        if isinstance(chrom, (int, long)):
+            return self.contig_ids[chrom] if 0 <= chrom < len(self.contig_ids) else None
+        return chrom
+
+    def windows_to_genes(self, windows):
+        """input: list of [contig or chromosome index, start, end] windows
+        return: genes overlapping any window, each gene once"""
+        by_contig = {}
+        for chrom, start, end in windows:
+            contig = self.contig(chrom)
+            if contig in self.contigs:
+                by_contig.setdefault(contig, []).append((start, end))
+        genes = []
+        for contig in sorted(by_contig.keys(), key=_natural_key):
+            starts, ends, fids = self.contigs[contig]
+            # merge overlapping windows, then sweep each merged window over genes sorted by start
+            merged = []
+            for start, end in sorted(by_contig[contig]):
+                if merged and (start <= merged[-1][1]):
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            seen = set()
+            for start, end in merged:
+                lo = bisect.bisect_left(starts, start - self.max_len[contig])
+                hi = bisect.bisect_right(starts, end)
+                for i in xrange(lo, hi):
+                    if (ends[i] >= start) and (i not in seen):
+                        seen.add(i)
+            for i in sorted(seen):
+                genes.append([contig, fids[i], starts[i], ends[i], self.functions.get(fids[i], '')])
+        return {'genes': genes}
+
+    def variations_to_genes(self, chromosomal_positions, distance):
+        """genes within distance of any [contig or chromosome index, position]"""
+        return self.windows_to_genes(map(lambda x: (x[0], x[1] - distance, x[1] + distance), chromosomal_positions))
+
+    def traits_to_genes(self, track, pvaluecutoff, distance):
+        """genes within distance of variations of plant.VariationTrack with -log10(p-value) >= pvaluecutoff"""
+        return self.selected_locations_to_genes(track, pvaluecutoff, None, None, distance)
+
+    def selected_locations_to_genes(self, track, pmin, pmax, chromosomal_locations, distance):
+        """genes within distance of variations of plant.VariationTrack with -log10(p-value) within pmin and pmax,
+        optionally only variations inside chromosomal_locations: list of [contig or chromosome index, start, end]"""
+        regions = None
+        if chromosomal_locations:
+            regions = {}
+            for chrom, start, end in chromosomal_locations:
+                regions.setdefault(self.contig(chrom), []).append((start, end))
+        positions = []
+        for i in xrange(len(track.pos)):
+            y = track.logp[i]
+            if ((pmin is not None) and (y < pmin)) or ((pmax is not None) and (y > pmax)):
+                continue
+            contig = self.contig(track.chrom[i])
+            if (regions is not None) and (not any(s <= track.pos[i] <= e for s, e in regions.get(contig, ()))):
+                continue
+            positions.append((contig, track.pos[i]))
+        return self.variations_to_genes(positions, distance)
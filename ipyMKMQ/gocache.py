@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import sys, math
+from ipyTools import *
+import ontology
+from rpc import RPCClient
+
+class GOCache(object):
+    """Local cache of ontology.Ontology GO data, with batch enrichment over many gene lists:
+        genes : { gene id : list of go ids, from get_goidlist(genes, domain_list, ec_list) }
+        descs : { go id : result of get_go_description for that id }
+    only genes / go ids not yet cached are sent to the service (chunked, concurrent).
+    save() writes the cache to Ipy.CCH_DIR/go_cache.json (created if missing), which is loaded again on creation.
+    gene annotations depend on domain_list and ec_list, the file keeps them apart per (domain_list, ec_list).
+
+    go = GOCache(domain_list=['biological_process'], ec_list=['IEA'])
+    go.enrichment([cluster1_genes, cluster2_genes])          # local hypergeometric tests
+    go.service_enrichment([cluster1_genes, cluster2_genes])  # one batched request to the service
+    """
+    def __init__(self, api=None, domain_list=[], ec_list=[], fname=None):
+        if api is None:
+            api = ontology.Ontology(Ipy.ONTOLOGY_URL)
+        self.rpc = api if isinstance(api, RPCClient) else RPCClient(api)
+        self.domain_list = domain_list
+        self.ec_list = ec_list
+        self.fname = fname if fname else Ipy.CCH_DIR+'/go_cache.json'
+        self.genes = {}
+        self.descs = {}
+        data = self._load()
+        self.genes = data['genes'].get(self._key(), {})
+        self.descs = data['descs']
+
+    def _key(self):
+        return json.dumps([sorted(self.domain_list), sorted(self.ec_list)])
+
+    def _load(self):
+        # 'genes' is { json [domain_list, ec_list] : { gene id : go ids } }
+        data = {'genes': {}, 'descs': {}}
+        if os.path.isfile(self.fname):
+            found = json.load(open(self.fname, 'rU'))
+            if found.get('version') == 2:
+                data.update(found)
+            else:
+                # older files have genes of unknown domain / ec lists, keep only descriptions
+                data['descs'] = found.get('descs', {})
+        return data
+
+    def save(self):
+        """merge into the cache file, keeping annotations saved for other domain / ec lists. returns None if not written"""
+        data = self._load()
+        data['genes'][self._key()] = self.genes
+        data['descs'].update(self.descs)
+        data['version'] = 2
+        return write_cache(self.fname, data)
+
+    def _goids(self, info):
+        # entries are go ids or go info structures
+        return sorted(set(map(lambda x: x.get('goID') if isinstance(x, dict) else x, info or [])))
+
+    def goids(self, gene_ids):
+        """returns { gene id : list of go ids }, genes without annotation map to an empty list"""
+        missing = sorted(filter(lambda x: x not in self.genes, set(gene_ids)))
+        if missing:
+            found = self.rpc.scatter('get_goidlist', missing, self.domain_list, self.ec_list)
+            for g in missing:
+                self.genes[g] = self._goids(found.get(g))
+        return dict([(g, self.genes[g]) for g in gene_ids])
+
+    def descriptions(self, go_ids):
+        """returns { go id : description }"""
+        missing = sorted(filter(lambda x: x not in self.descs, set(go_ids)))
+        if missing:
+            found = self.rpc.scatter('get_go_description', missing)
+            for t in missing:
+                self.descs[t] = found.get(t)
+        return dict([(t, self.descs[t]) for t in go_ids])
+
+    def enrichment(self, gene_lists, universe=None, max_pvalue=None):
+        """hypergeometric test of each go term in each gene list against universe
+        (default all genes of all lists), run locally on cached annotations.
+        returns list per gene list of [ {'goID', 'goDesc', 'pvalue', 'count', 'total'}, ... ] sorted by pvalue"""
+        if universe is None:
+            universe = set()
+            for genes in gene_lists:
+                universe.update(genes)
+        universe = set(universe)
+        annot = self.goids(universe)
+        # term counts in universe
+        term_n = {}
+        for g in universe:
+            for t in annot[g]:
+                term_n[t] = term_n.get(t, 0) + 1
+        num = len(universe)
+        lfact = array.array('d', [0.0])
+        for i in xrange(1, num+1):
+            lfact.append(lfact[i-1] + math.log(i))
+        lchoose = lambda n, k: lfact[n] - lfact[k] - lfact[n-k]
+        base = {}
+        memo = {}
+        results = []
+        used = set()
+        for genes in gene_lists:
+            genes = filter(lambda x: x in universe, set(genes))
+            size  = len(genes)
+            hits  = {}
+            for g in genes:
+                for t in annot[g]:
+                    hits[t] = hits.get(t, 0) + 1
+            curr = []
+            for t, k in hits.iteritems():
+                big = term_n[t]
+                # P(X >= k), X ~ hypergeometric(num, big, size), same (k, big, size) is only computed once
+                if (k, big, size) not in memo:
+                    if size not in base:
+                        base[size] = lchoose(num, size)
+                    pval = sum(math.exp(lchoose(big, i) + lchoose(num-big, size-i) - base[size]) for i in xrange(k, min(big, size)+1))
+                    memo[(k, big, size)] = min(pval, 1.0)
+                pval = memo[(k, big, size)]
+                if (max_pvalue is None) or (pval <= max_pvalue):
+                    curr.append({'goID': t, 'pvalue': pval, 'count': k, 'total': big})
+                    used.add(t)
+            results.append(sorted(curr, key=lambda x: (x['pvalue'], x['goID'])))
+        descs = self.descriptions(used)
+        for curr in results:
+            for r in curr:
+                r['goDesc'] = descs.get(r['goID'])
+        return results
+
+    def service_enrichment(self, gene_lists, type='hypergeometric', ontologytype='GO'):
+        """get_go_enrichment for each gene list, sent to the service as one batched request.
+        returns list of results in order of gene_lists"""
+        return self.rpc.batch(map(lambda x: ('get_go_enrichment', [x, self.domain_list, self.ec_list, type, ontologytype]), gene_lists))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""Timers and counters for the slow stages of a notebook session: network calls, json decoding,
+matrix conversion, R calls, temp file parsing and display. Disabled by default, then each
+instrumented call only costs one flag check.
+
+    instrument.enable()
+    ... notebook code ...
+    print instrument.summary()
+    instrument.export_trace('trace.json')   # open in chrome://tracing
+
+Profile records the call tree of the spans inside one block only, also when instrument is not enabled:
+
+    with Profile() as p:
+        ... notebook code ...
+    p.show()
+"""
+
+import os, json, threading
+from time import time
+from functools import wraps
+
+_STATE  = {'enabled': False, 'trace': False, 'start': time()}
+_LOCK   = threading.Lock()
+_TIMERS = {}  # name : [calls, total seconds, max seconds]
+_COUNTS = {}  # name : value
+_EVENTS = []  # chrome trace events
+_LOCAL  = threading.local()  # per thread stack of open spans
+_PROFILES = []  # active Profile objects
+MAX_EVENTS = 100000
+FLAME_COLORS = ['#3366cc', '#dc3912', '#ff9900', '#109618', '#990099', '#0099c6', '#dd4477', '#66aa00', '#b82e2e', '#316395']
+
+def enable(trace=True):
+    """start collecting timers and counters, and trace events if trace"""
+    _STATE['enabled'] = True
+    _STATE['trace'] = trace
+
+def disable():
+    _STATE['enabled'] = False
+
+def enabled():
+    """True if spans are recorded, globally or by a Profile"""
+    return _STATE['enabled'] or bool(_PROFILES)
+
+def reset():
+    with _LOCK:
+        _TIMERS.clear()
+        _COUNTS.clear()
+        del _EVENTS[:]
+        _STATE['start'] = time()
+
+def count(name, value=1):
+    """add value to counter name, ie. count('http.bytes', len(data)), count('cache.metagenome.hit')"""
+    if _STATE['enabled'] or _PROFILES:
+        with _LOCK:
+            if _STATE['enabled']:
+                _COUNTS[name] = _COUNTS.get(name, 0) + value
+            for prof in _PROFILES:
+                prof.counts[name] = prof.counts.get(name, 0) + value
+
+def _stack():
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    return stack
+
+def bound(func):
+    """returns func wrapped so spans it opens in another thread (ie. a pool worker) nest under the spans open here.
+    used by map_concurrent / apply_concurrent, func itself is returned when nothing is recorded"""
+    if not (_STATE['enabled'] or _PROFILES):
+        return func
+    stack = _stack()
+    base  = stack[-1].path if stack else ()
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        prev = getattr(_LOCAL, 'base', ())
+        _LOCAL.base = base
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _LOCAL.base = prev
+    return wrapper
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'stime', 'path', 'based')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            self.path  = stack[-1].path + (self.name,)
+            self.based = stack[-1].based
+        else:
+            # first span of a bound call in a worker thread continues the path of the submitting thread
+            base = getattr(_LOCAL, 'base', ())
+            self.path  = base + (self.name,)
+            self.based = bool(base)
+        self.stime = time()
+        stack.append(self)
+        return self
+
+    def __exit__(self, etype, evalue, tb):
+        secs = time() - self.stime
+        _stack().pop()
+        with _LOCK:
+            for prof in _PROFILES:
+                prof._add(self.path, secs, self.based)
+            if not _STATE['enabled']:
+                return False
+            curr = _TIMERS.get(self.name)
+            if curr is None:
+                _TIMERS[self.name] = [1, secs, secs]
+            else:
+                curr[0] += 1
+                curr[1] += secs
+                if secs > curr[2]:
+                    curr[2] = secs
+            if _STATE['trace'] and (len(_EVENTS) < MAX_EVENTS):
+                event = { 'name': self.name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                          'ts': int((self.stime - _STATE['start']) * 1e6), 'dur': int(secs * 1e6) }
+                if self.args:
+                    event['args'] = self.args
+                _EVENTS.append(event)
+        return False
+
+class _NoSpan(object):
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, etype, evalue, tb):
+        return False
+
+_NOSPAN = _NoSpan()
+
+def span(name, **args):
+    """context manager timing the block as name: with span('R', cmd='heatmap'): ..."""
+    if _STATE['enabled'] or _PROFILES:
+        return _Span(name, args)
+    return _NOSPAN
+
+def timed(name):
+    """decorator timing every call of the function as name"""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (_STATE['enabled'] or _PROFILES):
+                return func(*args, **kwargs)
+            with _Span(name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def timers():
+    """returns { name : (calls, total seconds, max seconds) }"""
+    with _LOCK:
+        return dict([(k, tuple(v)) for k, v in _TIMERS.iteritems()])
+
+def counters():
+    with _LOCK:
+        return dict(_COUNTS)
+
+def summary():
+    """returns text table of timers (sorted by total time), counters and cache hit rates"""
+    lines = [ "%-32s %8s %10s %10s %10s"%('stage', 'calls', 'total s', 'mean ms', 'max ms') ]
+    for name, (calls, total, most) in sorted(timers().iteritems(), key=lambda x: -x[1][1]):
+        lines.append( "%-32s %8d %10.3f %10.2f %10.2f"%(name, calls, total, total * 1000 / calls, most * 1000) )
+    counts = counters()
+    if counts:
+        lines.append('')
+        lines.append( "%-32s %12s"%('counter', 'value') )
+        for name in sorted(counts.keys()):
+            lines.append( "%-32s %12d"%(name, counts[name]) )
+    rates = []
+    bases = set([ k.rsplit('.', 1)[0] for k in counts.keys() if k.endswith('.hit') or k.endswith('.miss') ])
+    for base in sorted(bases):
+        hits, miss = counts.get(base+'.hit', 0), counts.get(base+'.miss', 0)
+        if hits + miss:
+            rates.append( "%-32s %11.1f%%"%(base, 100.0 * hits / (hits + miss)) )
+    if rates:
+        lines.append('')
+        lines.append( "%-32s %12s"%('cache', 'hit rate') )
+        lines.extend(rates)
+    return "\n".join(lines)
+
+def export_trace(fname):
+    """write recorded spans as chrome trace event json (chrome://tracing, perfetto), returns fname"""
+    with _LOCK:
+        events = list(_EVENTS)
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, open(fname, 'w'))
+    return fname
+
+class Profile(object):
+    """Call tree of the spans recorded while the profile is active (use as context manager, or start() / stop()).
+    spans run through map_concurrent / apply_concurrent are put under the span they were submitted from,
+    spans opened in other threads under a 'worker threads' node.
+        self.root   : {'name', 'calls', 'secs', 'children': {name: node}}, root secs is the wall time of the block
+        self.counts : counters (bytes, cache hits) of the block
+    report() returns an indented text tree, html() / show() a flame style chart, both also shown by the notebook"""
+    def __init__(self, name='profile'):
+        self.root = {'name': name, 'calls': 1, 'secs': 0.0, 'children': {}}
+        self.counts = {}
+        self._thread = None
+        self._stime  = None
+
+    def start(self):
+        self._thread = threading.current_thread().ident
+        self._stime  = time()
+        with _LOCK:
+            _PROFILES.append(self)
+        return self
+
+    def stop(self):
+        with _LOCK:
+            if self in _PROFILES:
+                _PROFILES.remove(self)
+        self.root['secs'] = time() - self._stime
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, etype, evalue, tb):
+        self.stop()
+        return False
+
+    def _add(self, path, secs, based=False):
+        # called with _LOCK held
+        if (not based) and (threading.current_thread().ident != self._thread):
+            path = ('worker threads',) + path
+        node = self.root
+        for name in path:
+            child = node['children'].get(name)
+            if child is None:
+                child = node['children'][name] = {'name': name, 'calls': 0, 'secs': 0.0, 'children': {}}
+            node = child
+        node['calls'] += 1
+        node['secs'] += secs
+
+    def _sorted(self, node):
+        return sorted(node['children'].values(), key=lambda x: -x['secs'])
+
+    def report(self, min_secs=0.0):
+        """returns text call tree: total seconds, self seconds, calls, name. nodes below min_secs are left out"""
+        lines = [ "%10s %10s %8s  %s"%('total s', 'self s', 'calls', 'stage') ]
+        def walk(node, depth):
+            own = node['secs'] - sum(map(lambda x: x['secs'], node['children'].values()))
+            lines.append( "%10.3f %10.3f %8d  %s%s"%(node['secs'], max(own, 0.0), node['calls'], '  '*depth, node['name']) )
+            for child in self._sorted(node):
+                if child['secs'] >= min_secs:
+                    walk(child, depth+1)
+        walk(self.root, 0)
+        if self.counts:
+            lines.append('')
+            for name in sorted(self.counts.keys()):
+                lines.append( "%-32s %12d"%(name, self.counts[name]) )
+        return "\n".join(lines)
+
+    def html(self, width=900, row=18):
+        """returns flame style html chart: one row per call depth, box width is share of the block time"""
+        boxes = []
+        total = self.root['secs'] or 1e-9
+        def walk(node, depth, left, scale):
+            boxes.append((depth, left, node['secs'] * scale / total, node))
+            # children in worker threads can add up to more than their parent, squeeze them into it
+            scale *= min(1.0, node['secs'] / (sum(map(lambda x: x['secs'], node['children'].values())) or 1e-9))
+            for child in self._sorted(node):
+                walk(child, depth+1, left, scale)
+                left += child['secs'] * scale / total
+        walk(self.root, 0, 0.0, 1.0)
+        depth = max(map(lambda x: x[0], boxes)) + 1
+        divs = []
+        for d, left, frac, node in boxes:
+            if frac * width < 1:
+                continue
+            title = "%s: %.3f s, %d calls"%(node['name'], node['secs'], node['calls'])
+            color = FLAME_COLORS[sum(map(ord, node['name'])) % len(FLAME_COLORS)]
+            divs.append( "<div title='%s' style='position:absolute; overflow:hidden; white-space:nowrap; box-sizing:border-box; border:1px solid white; "
+                         "left:%.1fpx; top:%dpx; width:%.1fpx; height:%dpx; background:%s; color:white; font:11px sans-serif; padding-left:2px'>%s</div>"
+                         %(title, left * width, d * row, frac * width, row, color, node['name']) )
+        return "<div style='position:relative; width:%dpx; height:%dpx'>%s</div><pre>%s</pre>"%(width, depth * row, "".join(divs), self.report())
+
+    def show(self):
+        import IPython.core.display
+        IPython.core.display.display_html(IPython.core.display.HTML(data=self.html()))
+
+    def _repr_html_(self):
+        return self.html()
+
+    def __repr__(self):
+        return self.report()
@@ -1,12 +1,10 @@
 #!/usr/bin/env python
 
-from time import localtime, strftime, sleep
+from time import localtime, strftime, sleep, time
 from collections import defaultdict
 import os, sys, urllib, urllib2, json, pickle, copy, glob
-import string, random, math, array
-import rpy2.robjects as ro
-import retina, flotplot
-import config
+import string, random, math, array, bisect, threading
+import config, instrument
 
 # class for ipy lib env
 class Ipy(object):
@@ -14,6 +12,7 @@ class Ipy(object):
     auth = None
     username = None
     DEBUG   = False
+    WORKERS = 8
     FL_PLOT = None
     RETINA  = None
     NB_DIR  = None
@@ -22,11 +21,31 @@ class Ipy(object):
     CCH_DIR = None
     IMG_DIR = None
     KBASE_CMDS = None
+    R_LIBS  = ['matR', 'gplots', 'scatterplot3d']
+    STARTUP = {}
+    STARTUP_BUDGET = 2.0
+    SHM_DIR = None # shared matrix store, ie. '/dev/shm/ipymkmq', see shmstore.py
+    SHM_TRUSTED_GIDS = [] # groups whose shared matrices are attached, besides your own
+    SHM_MAX_MB  = 1024 # size of shared matrix store, least recently used of your matrices are removed above it
+    SHM_MAX_AGE = 86400 # seconds your unused shared matrices are kept
     KBASE_IPY = "\n".join(['get_analysis_set','Analysis','AnalysisSet','get_collection','Collection','Project','Metagenome','QC','Drisee','NucleoProfile','Kmer','Rarefaction','merge_drisee_profile','get_plant_set','Plant'])
     VALUES  = ['abundance', 'evalue', 'identity', 'length']
     TAX_SET = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species']
     ONT_SET = ['level1', 'level2', 'level3', 'function']
     MD_CATS = ['project', 'sample', 'library', 'env_package']
+    MG_SENT = {} # page token : { metagenome id : set of sent fields }
+    MG_PAGE = None # token of the notebook page last sent to
+    MG_BASE = ['id', 'name', 'sequence_type', 'status', 'created', 'version', 'url', 'project', 'library', 'sample']
+    MG_VIEWS = { 'summary_chart': ['statistics.sequence_stats'],
+                 'summary_stats': ['statistics.sequence_stats'],
+                 'annotation_chart': ['statistics.taxonomy', 'statistics.ontology'],
+                 'bp_histogram': ['statistics.qc.bp_profile'],
+                 'drisee': ['statistics.qc.drisee'],
+                 'kmer': ['statistics.qc.kmer'],
+                 'rarefaction': ['statistics.rarefaction', 'statistics.sequence_stats'],
+                 'rank_abundance': ['statistics.taxonomy'],
+                 'mixs': ['mixs'],
+                 'metadata': ['metadata'] }
     MATRIX  = { 'annotation': 'organism',
                 'level': 'strain',
                 'result_type': 'abundance',
@@ -69,7 +88,10 @@ class Ipy(object):
                 "#0c5922",
                 "#743411" ]
 
-def init_ipy(debug=False, nb_dir=None, api_url=None):
+def init_ipy(debug=False, nb_dir=None, api_url=None, preload=False):
+    """R and the plotting libraries are loaded on first use, unless preload is True.
+    time taken is recorded in Ipy.STARTUP, a warning is printed if init_ipy takes more than Ipy.STARTUP_BUDGET seconds"""
+    stime = time()
     # get config
     for c in filter(lambda x: not x.startswith('_'), config.__dict__.keys()):
         setattr(Ipy, c, getattr(config, c))
@@ -88,37 +110,192 @@ def init_ipy(debug=False, nb_dir=None, api_url=None):
     # set api
     if api_url is not None:
         Ipy.API_URL = api_url
-    # set graphing tools
-    Ipy.FL_PLOT = flotplot.FlotPlot()
-    Ipy.RETINA  = retina.Retina()
+    # set graphing tools, javascript is injected on first render
+    Ipy.FL_PLOT = LazyLoader('flotplot', _load_flotplot, _time_display('display.flotplot'))
+    Ipy.RETINA  = LazyLoader('retina', _load_retina, _time_display('display.retina'))
     Ipy.DEBUG   = debug
-    # load matR and extras
-    ro.r('suppressMessages(library(matR))')
-    ro.r('suppressMessages(library(gplots))')
-    ro.r('suppressMessages(library(scatterplot3d))')
-    # add tab completion from a dir - bit of a hack
-    #   skip names with hyphen '-' in them, its an operator and not valid name syntax :(
-    #   these are for kbase command line scripts, no .pl
-    names = map(lambda x: os.path.basename(x), glob.glob(Ipy.KBASE_BIN+'/*'))
-    names = filter(lambda x: (not x.endswith('.pl')) and (not x.endswith('.py')), names)
-    Ipy.KBASE_CMDS = "\n".join(names)
-    names = filter(lambda x: '-' not in x, names)
-    add_tab_completion(names)
+    if preload:
+        for lazy in (ro, Ipy.FL_PLOT, Ipy.RETINA):
+            lazy.load()
+    # tab completion of kbase commands, KBASE_BIN is only listed on first completion
+    add_tab_completion()
+    # %%profile cell magic
+    add_profile_magic()
+    Ipy.STARTUP['init_ipy'] = time() - stime
+    if Ipy.STARTUP['init_ipy'] > Ipy.STARTUP_BUDGET:
+        sys.stderr.write("Warning: init_ipy took %.2f seconds, startup budget is %.2f seconds\n"%(Ipy.STARTUP['init_ipy'], Ipy.STARTUP_BUDGET))
     # echo
     if Ipy.DEBUG:
         for k in filter(lambda x: not x.startswith('_'), Ipy.__dict__.keys()):
             print k, getattr(Ipy, k)
 
-def add_tab_completion(names):
-    for n in names:
-        cmd = "%s = func_factory(); dir(%s)"%(n,n)
-        exec(cmd)
+class LazyLoader(object):
+    """Stands in for an object that is slow to create (R session, javascript libraries),
+    which is created on first attribute access. load time is recorded in Ipy.STARTUP[name].
+    wrap(attr name, value), if given, is applied to every attribute read, ie. to time method calls"""
+    def __init__(self, name, loader, wrap=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_loader'] = loader
+        self.__dict__['_wrap'] = wrap
+        self.__dict__['_obj'] = None
+
+    def load(self):
+        if self._obj is None:
+            stime = time()
+            self.__dict__['_obj'] = self._loader()
+            Ipy.STARTUP[self._name] = time() - stime
+            if Ipy.DEBUG:
+                sys.stdout.write("loaded %s in %.2f seconds\n"%(self._name, Ipy.STARTUP[self._name]))
+        return self._obj
+
+    def loaded(self):
+        return self._obj is not None
+
+    def __getattr__(self, name):
+        value = getattr(self.load(), name)
+        if self._wrap and instrument.enabled():
+            return self._wrap(name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __repr__(self):
+        return repr(self._obj) if self.loaded() else "<%s, not loaded>"%self._name
+
+class _TimedR(object):
+    """rpy2 r object whose calls are timed as 'R' (r('code')) and 'R.<function>' (r.function())"""
+    def __init__(self, r):
+        self._r = r
+
+    def __call__(self, code):
+        with instrument.span('R', code=code[:80]):
+            return self._r(code)
+
+    def __getattr__(self, name):
+        value = getattr(self._r, name)
+        if callable(value):
+            return _time_call('R.'+name, value)
+        return value
+
+def _time_call(name, func):
+    def timed(*args, **kwargs):
+        with instrument.span(name):
+            return func(*args, **kwargs)
+    return timed
 
-def func_factory():
-    """function to return empty functions for adding to python namespace"""
-    def func():
+def _time_r(name, value):
+    return _TimedR(value) if name == 'r' else value
+
+def _time_display(prefix):
+    return lambda name, value: _time_call(prefix+'.'+name, value) if callable(value) else value
+
+def _load_r():
+    import rpy2.robjects
+    for lib in Ipy.R_LIBS:
+        rpy2.robjects.r('suppressMessages(library(%s))'%lib)
+    return rpy2.robjects
+
+def _load_retina():
+    import retina
+    return retina.Retina()
+
+def _load_flotplot():
+    import flotplot
+    return flotplot.FlotPlot()
+
+# R session with matR and extras, started on first use of ro
+ro = LazyLoader('R', _load_r, _time_r)
+
+_KBASE_INDEX = {'dir': None, 'mtime': None, 'names': []}
+
+def kbase_commands():
+    """sorted list of kbase command line scripts in Ipy.KBASE_BIN (no .pl / .py),
+    the directory is only listed again when its mtime changes. also sets Ipy.KBASE_CMDS"""
+    try:
+        mtime = os.stat(Ipy.KBASE_BIN).st_mtime
+    except (OSError, TypeError):
+        return []
+    if (_KBASE_INDEX['dir'] != Ipy.KBASE_BIN) or (_KBASE_INDEX['mtime'] != mtime):
+        names = filter(lambda x: (not x.endswith('.pl')) and (not x.endswith('.py')), os.listdir(Ipy.KBASE_BIN))
+        _KBASE_INDEX.update({'dir': Ipy.KBASE_BIN, 'mtime': mtime, 'names': sorted(names)})
+        Ipy.KBASE_CMDS = "\n".join(_KBASE_INDEX['names'])
+    return _KBASE_INDEX['names']
+
+def complete_kbase(text):
+    """kbase commands starting with text"""
+    if not text:
+        return []
+    names = kbase_commands()
+    found = []
+    for i in xrange(bisect.bisect_left(names, text), len(names)):
+        if not names[i].startswith(text):
+            break
+        found.append(names[i])
+    return found
+
+def add_tab_completion():
+    """add complete_kbase to the completers of the running IPython shell, returns False if there is none"""
+    try:
+        from IPython import get_ipython
+        shell = get_ipython()
+    except ImportError:
+        return False
+    if (shell is None) or (complete_kbase in shell.Completer.matchers):
+        return shell is not None
+    shell.Completer.matchers.append(complete_kbase)
+    return True
+
+def profile(name='profile'):
+    """returns instrument.Profile recording the call tree of network, cache, matrix, R and display calls
+    of a block, displayed as flame chart in the notebook:
+        with profile() as p:
+            mg_set.heatmap()
+        p
+    """
+    return instrument.Profile(name)
+
+def _profile_cell(line, cell):
+    from IPython import get_ipython
+    with profile(line.strip() or 'cell') as prof:
+        get_ipython().ex(cell)
+    prof.show()
+
+def add_profile_magic():
+    """register %%profile cell magic in the running IPython shell, returns False if there is none"""
+    try:
+        from IPython import get_ipython
+        shell = get_ipython()
+    except ImportError:
+        return False
+    if shell is None:
+        return False
+    shell.register_magic_function(_profile_cell, 'cell', 'profile')
+    return True
+
+def cache_path(fname):
+    """returns fname, with its directory (ie. Ipy.CCH_DIR) created if missing. None if that is not possible"""
+    dname = os.path.dirname(fname)
+    if dname and (not os.path.isdir(dname)):
+        try:
+            os.makedirs(dname)
+        except OSError:
+            if not os.path.isdir(dname):
+                return None
+    return fname
+
+def write_cache(fname, data):
+    """write data as json to cache file fname. returns fname, None if not written, the error is only reported"""
+    try:
+        if not cache_path(fname):
+            raise IOError("can not create directory %s"%os.path.dirname(fname))
+        text = json.dumps(data, separators=(',', ':'))
+        with open(fname, 'w') as fhdl:
+            fhdl.write(text)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Error: unable to save cache file %s: %s\n"%(fname, e))
         return None
-    return func
+    return fname
 
 def save_object(obj, name):
     """save some object to python pickle file"""
@@ -133,13 +310,16 @@ def load_object(name):
     """load object from python pickle file"""
     fpath = Ipy.CCH_DIR+'/'+name+'.pkl'
     if os.path.isfile(fpath):
+        instrument.count('cache.object.hit')
         try:
-            return pickle.load(open(fpath, 'r'))
+            with instrument.span('pickle.load'):
+                return pickle.load(open(fpath, 'r'))
         except:
             if Ipy.DEBUG:
                 sys.stderr.write("Error loading pickeled object from %s\n"%fpath)
             return None
     else:
+        instrument.count('cache.object.miss')
         if Ipy.DEBUG:
             sys.stderr.write("can not create from pickeled object, %s does not exist\n"%fpath)
         return None
@@ -163,15 +343,19 @@ def obj_from_url(url, auth=None):
         print json.dumps(header)
         print url
     try:
-        req = urllib2.Request(url, headers=header)
-        res = urllib2.urlopen(req)
+        with instrument.span('http', url=url):
+            req  = urllib2.Request(url, headers=header)
+            res  = urllib2.urlopen(req)
+            data = res.read() if res else None
     except urllib2.HTTPError, error:
         sys.stderr.write("ERROR (%s):%s, %s\n"%(url, error.code, error.read()))
         return None
     if not res:
         sys.stderr.write("ERROR (%s): no results returned\n"%url)
         return None
-    obj = json.loads(res.read())
+    instrument.count('http.bytes', len(data))
+    with instrument.span('json.decode'):
+        obj = json.loads(data)
     if obj is None:
         sys.stderr.write("ERROR (%s): return structure not valid json format\n"%url)
         return None
@@ -183,17 +367,173 @@ def obj_from_url(url, auth=None):
         return None
     return obj
 
-def async_rest_api(url, auth=None, delay=30):
-    submit = obj_from_url(url, auth)
-    if not (('status' in submit) and (submit['status'] == 'Submitted') and ('url' in submit)):
-        sys.stderr.write("ERROR: return data invalid format\n:%s"%json.dumps(submit))
-    result = obj_from_url(submit['url'])
-    while result['status'] != 'done':
-        sleep(delay)
-        result = obj_from_url(submit['url'])
-    return result['data']
+_POOL = None
+_WORKER = threading.local()
+
+def _mark_worker():
+    _WORKER.active = True
+
+def in_worker():
+    """True if called from a thread of the shared worker pool"""
+    return getattr(_WORKER, 'active', False)
+
+def worker_pool():
+    """shared pool of Ipy.WORKERS threads used for all concurrent network calls"""
+    global _POOL
+    if _POOL is None:
+        from multiprocessing.pool import ThreadPool
+        _POOL = ThreadPool(Ipy.WORKERS, initializer=_mark_worker)
+    return _POOL
+
+def map_concurrent(func, items, workers=None):
+    """apply func to each item using the shared worker pool, returns list of results in item order.
+    workers=1 runs sequentially in the calling thread, so do calls from inside a pool worker:
+    waiting on the pool from one of its own threads can deadlock it"""
+    items = list(items)
+    if (len(items) < 2) or (workers == 1) or in_worker():
+        return map(func, items)
+    return worker_pool().map(instrument.bound(func), items, chunksize=1)
+
+class _DoneResult(object):
+    """AsyncResult look-alike for a call already run in the calling thread"""
+    def __init__(self, func, args, kwargs):
+        self._error = None
+        self._value = None
+        try:
+            self._value = func(*args, **kwargs)
+        except Exception as e:
+            self._error = e
+
+    def get(self, timeout=None):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def wait(self, timeout=None):
+        pass
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._error is None
+
+def apply_concurrent(func, *args, **kwargs):
+    """run func in the shared worker pool, returns AsyncResult: call .get() for the result.
+    called from inside a pool worker func is run right away in the calling thread"""
+    if in_worker():
+        return _DoneResult(func, args, kwargs)
+    return worker_pool().apply_async(instrument.bound(func), args, kwargs)
+
+def obj_from_urls(urls, auth=None):
+    """fetch many API urls concurrently, returns list of objects (None for failures) in url order"""
+    return map_concurrent(lambda x: obj_from_url(x, auth), urls)
+
+def async_rest_api(url, auth=None, delay=30, timeout=None):
+    """submit asynchronous API call and wait for its result.
+    status is polled with exponential backoff starting at 1 second, up to 'delay' seconds between polls.
+    returns None if job fails or 'timeout' seconds pass"""
+    jobs = AsyncJobs(auth=auth, max_delay=delay)
+    job = jobs.submit(url, timeout=timeout)
+    if job is None:
+        return None
+    jobs.wait()
+    return jobs.result(job)
+
+class AsyncJobs(object):
+    """Poll many asynchronous API jobs from one loop:
+        submit(url)  : submit job, returns status url used as job id
+        add(url)     : track an already submitted job by its status url
+        wait()       : poll until all (or given) jobs are done, failed, cancelled or past deadline
+        cancel(job)  : stop tracking job
+        result(job)  : returns job data when done, else None
+    each job is polled with exponential backoff and jitter, starting at 'delay' seconds up to 'max_delay'.
+    'retries' consecutive invalid responses mark a job failed.
+    """
+    def __init__(self, auth=None, delay=1, max_delay=30, backoff=2, jitter=0.25, retries=5):
+        self.auth = auth
+        self.delay = delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.retries = retries
+        self.jobs = {}
+
+    def submit(self, url, timeout=None):
+        submit = obj_from_url(url, self.auth)
+        if not (submit and ('status' in submit) and (submit['status'] == 'Submitted') and ('url' in submit)):
+            sys.stderr.write("ERROR: return data invalid format\n:%s"%json.dumps(submit))
+            return None
+        return self.add(submit['url'], timeout=timeout)
+
+    def add(self, url, timeout=None):
+        self.jobs[url] = { 'status': 'submitted',
+                           'data': None,
+                           'delay': self.delay,
+                           'errors': 0,
+                           'next': time(),
+                           'deadline': (time() + timeout) if timeout else None }
+        return url
+
+    def cancel(self, job=None):
+        """cancel given job, or all running jobs"""
+        for url in ([job] if job else self.jobs.keys()):
+            if self.running(url):
+                self.jobs[url]['status'] = 'cancelled'
+
+    def running(self, job):
+        return (job in self.jobs) and (self.jobs[job]['status'] in ['submitted', 'processing'])
+
+    def result(self, job):
+        if (job in self.jobs) and (self.jobs[job]['status'] == 'done'):
+            return self.jobs[job]['data']
+        return None
+
+    def poll(self):
+        """poll all running jobs that are due, returns seconds until next job is due or None if none running"""
+        now = time()
+        next_due = None
+        for url, job in self.jobs.iteritems():
+            if not self.running(url):
+                continue
+            if job['deadline'] and (now >= job['deadline']):
+                sys.stderr.write("ERROR (%s): job did not finish within timeout\n"%url)
+                job['status'] = 'expired'
+                continue
+            if now >= job['next']:
+                res = obj_from_url(url, self.auth)
+                if not (res and ('status' in res)):
+                    job['errors'] += 1
+                    if job['errors'] >= self.retries:
+                        job['status'] = 'failed'
+                        continue
+                elif res['status'] == 'done':
+                    job['status'] = 'done'
+                    job['data'] = res['data'] if 'data' in res else None
+                    continue
+                else:
+                    job['status'] = 'processing'
+                    job['errors'] = 0
+                job['next'] = time() + (job['delay'] * random.uniform(1 - self.jitter, 1 + self.jitter))
+                job['delay'] = min(job['delay'] * self.backoff, self.max_delay)
+            due = job['next'] if job['deadline'] is None else min(job['next'], job['deadline'])
+            next_due = due if next_due is None else min(next_due, due)
+        if next_due is None:
+            return None
+        return max(0, next_due - time())
+
+    def wait(self, jobs=None):
+        """poll until given jobs (default all) are no longer running"""
+        while True:
+            wait_time = self.poll()
+            if (wait_time is None) or (jobs and (not any(map(self.running, jobs)))):
+                break
+            sleep(wait_time)
 
 def slice_column(matrix, index):
+    if hasattr(matrix, 'column'):
+        # mmatrix.MappedMatrix, strided read
+        return matrix.column(index).tolist()
     data = []
     for row in matrix:
         data.append(row[index])
@@ -206,6 +546,7 @@ def toNum(s):
     except ValueError:
         return float(s)
 
+@instrument.timed('file.parse')
 def matrix_from_file(fname, has_col_names=True, has_row_names=True):
     fhdl = open(fname, 'rU')
     matrix = []
@@ -240,6 +581,7 @@ def matrix_to_file(fname=None, matrix=[], cols=None, rows=None):
     else:
         return output
 
+@instrument.timed('file.parse')
 def ordered_distance_from_file(fname):
     fhdl  = open(fname, 'rU')
     line1 = fhdl.readline()
@@ -252,6 +594,7 @@ def ordered_distance_from_file(fname):
     fhdl.close()
     return order_dist, dist_matrix
 
+@instrument.timed('file.parse')
 def eigen_data_from_file(fname):
     eigen_values  = []
     eigen_vectors = {}
@@ -333,21 +676,32 @@ def sparse_to_dense(sMatrix, rmax, cmax):
         dMatrix[r][c] = v
     return dMatrix
 
+@instrument.timed('matrix.py_to_r')
 def pyMatrix_to_rMatrix(matrix, rmax, cmax, normalize=0):
     if (not matrix) or (len(matrix) == 0):
         return None
     mList = []
-    for i in range(cmax):
+    if hasattr(matrix, 'columns'):
+        # mmatrix.MappedMatrix, all columns in one pass
+        for col in matrix.columns():
+            mList.extend(col.tolist())
         if normalize:
-            cList = map(lambda x: float(x[i]), matrix)
-        else:
-            cList = map(lambda x: int(x[i]), matrix)
-        mList.extend(cList)
+            mList = map(float, mList)
+        elif matrix.typecode != 'i':
+            mList = map(int, mList)
+    else:
+        for i in range(cmax):
+            if normalize:
+                cList = map(lambda x: float(x[i]), matrix)
+            else:
+                cList = map(lambda x: int(x[i]), matrix)
+            mList.extend(cList)
     if normalize:
         return ro.r.matrix(ro.FloatVector(mList), nrow=rmax)
     else:
         return ro.r.matrix(ro.IntVector(mList), nrow=rmax)
 
+@instrument.timed('matrix.r_to_py')
 def rMatrix_to_pyMatrix(matrix, rmax, cmax):
     if (not matrix) or (len(matrix) == 0):
         return None
@@ -360,6 +714,72 @@ def rMatrix_to_pyMatrix(matrix, rmax, cmax):
             col += 1
     return pyM
 
+def downsample_points(points, width, height=None, x_min=None, x_max=None, mode='minmax'):
+    """input: list of {'x': .., 'y': ..} points sorted by x, plot width (and height) in pixels
+    return: points within x_min - x_max reduced to what is visible at that plot size, first and last point are kept.
+    modes:
+        'minmax'  : lowest and highest point per pixel column, for line plots
+        'lttb'    : largest-triangle-three-buckets, about 2 points per pixel column, smoother but may drop extremes
+        'scatter' : one point per 2x2 pixel cell (needs height), for dot plots
+    pass a narrower x_min / x_max to get full detail of a zoomed region"""
+    if (x_min is not None) or (x_max is not None):
+        points = filter(lambda p: ((x_min is None) or (p['x'] >= x_min)) and ((x_max is None) or (p['x'] <= x_max)), points)
+    if (not points) or (not width) or (len(points) <= (width * 2)):
+        return points
+    if mode == 'lttb':
+        return _lttb(points, int(width * 2))
+    xlo = min(points[0]['x'], points[-1]['x']) if x_min is None else x_min
+    xhi = max(points[0]['x'], points[-1]['x']) if x_max is None else x_max
+    xspan = float(xhi - xlo) or 1.0
+    keep = {}
+    index = set([0, len(points) - 1])
+    if (mode == 'scatter') and height:
+        y_all = map(lambda p: p['y'], points)
+        ylo   = min(y_all)
+        yspan = float(max(y_all) - ylo) or 1.0
+        for i, p in enumerate(points):
+            cell = (int((p['x'] - xlo) / xspan * width / 2), int((p['y'] - ylo) / yspan * height / 2))
+            if cell not in keep:
+                keep[cell] = i
+        index.update(keep.values())
+        return map(lambda i: points[i], sorted(index))
+    for i, p in enumerate(points):
+        col = int((p['x'] - xlo) / xspan * width)
+        if col not in keep:
+            keep[col] = [i, i]
+        elif p['y'] < points[keep[col][0]]['y']:
+            keep[col][0] = i
+        elif p['y'] > points[keep[col][1]]['y']:
+            keep[col][1] = i
+    for lo, hi in keep.itervalues():
+        index.update([lo, hi])
+    return map(lambda i: points[i], sorted(index))
+
+def _lttb(points, threshold):
+    num = len(points)
+    if (threshold >= num) or (threshold < 3):
+        return points
+    every = float(num - 2) / (threshold - 2)
+    sampled = [ points[0] ]
+    a = 0
+    for i in xrange(threshold - 2):
+        # average of next bucket
+        start = int(math.floor((i + 1) * every)) + 1
+        end   = min(int(math.floor((i + 2) * every)) + 1, num)
+        avg_x = sum(p['x'] for p in points[start:end]) / float(end - start)
+        avg_y = sum(p['y'] for p in points[start:end]) / float(end - start)
+        # point of current bucket with largest triangle
+        ax, ay = points[a]['x'], points[a]['y']
+        max_area, next_a = -1, a
+        for j in xrange(int(math.floor(i * every)) + 1, start):
+            area = math.fabs((ax - avg_x) * (points[j]['y'] - ay) - (ax - points[j]['x']) * (avg_y - ay))
+            if area > max_area:
+                max_area, next_a = area, j
+        sampled.append(points[next_a])
+        a = next_a
+    sampled.append(points[-1])
+    return sampled
+
 def random_str(size=8):
     chars = string.ascii_letters + string.digits
     return ''.join(random.choice(chars) for x in range(size))
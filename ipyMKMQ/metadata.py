@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import bisect, math
+from collections import defaultdict
+import IPython.lib.display
+from ipyTools import *
+
+class MetadataIndex(object):
+    """Inverted index of metagenome metadata, updated as metagenomes are added:
+        fields : { category : set of field names }
+        values : { (category, field) : sorted list of distinct values }
+        mgids  : { (category, field) : { value : set of metagenome ids } }
+        nums   : { (category, field) : sorted list of (numeric value, metagenome id) }, finite values only
+    """
+    def __init__(self, mgs=[]):
+        self.fields = dict([(x, set()) for x in Ipy.MD_CATS])
+        self.values = defaultdict(list)
+        self.mgids  = {}
+        self.nums   = defaultdict(list)
+        self._added = set()
+        for mg in mgs:
+            self.add(mg)
+
+    def add(self, mg):
+        """add metadata of Metagenome object to index, each metagenome is only indexed once"""
+        if (mg.id in self._added) or (not getattr(mg, 'metadata', None)):
+            return
+        self._added.add(mg.id)
+        for cat in Ipy.MD_CATS:
+            if not (mg.metadata.get(cat) and mg.metadata[cat].get('data')):
+                continue
+            for field, val in mg.metadata[cat]['data'].iteritems():
+                key = (cat, field)
+                sval = unicode(val)
+                vmap = self.mgids.setdefault(key, {})
+                self.fields[cat].add(field)
+                if sval not in vmap:
+                    vmap[sval] = set()
+                    bisect.insort(self.values[key], sval)
+                vmap[sval].add(mg.id)
+                try:
+                    num = float(val)
+                except (ValueError, TypeError):
+                    continue
+                # nan / inf do not sort, they would break bisect
+                if not (math.isnan(num) or math.isinf(num)):
+                    bisect.insort(self.nums[key], (num, mg.id))
+
+    def has_field(self, field, category=None):
+        cats = [category] if category else self.fields.keys()
+        return any(field in self.fields.get(c, ()) for c in cats)
+
+    def search(self, category, field, value, match='substring'):
+        """return set of metagenome ids where value of category / field is:
+            'exact'     : equal to value
+            'prefix'    : starts with value
+            'substring' : contains value
+        """
+        key = (category, field)
+        if key not in self.mgids:
+            return set()
+        vmap  = self.mgids[key]
+        value = unicode(value)
+        found = set()
+        if match == 'exact':
+            found.update(vmap.get(value, ()))
+        elif match == 'prefix':
+            vals = self.values[key]
+            for i in xrange(bisect.bisect_left(vals, value), len(vals)):
+                if not vals[i].startswith(value):
+                    break
+                found.update(vmap[vals[i]])
+        elif match == 'substring':
+            for v in self.values[key]:
+                if value in v:
+                    found.update(vmap[v])
+        else:
+            sys.stderr.write("match must be one of: exact, prefix, substring\n")
+        return found
+
+    def search_range(self, category, field, min_value=None, max_value=None):
+        """return set of metagenome ids where numeric value of category / field is within min_value and max_value (inclusive)"""
+        nums = self.nums.get((category, field), [])
+        start = 0 if min_value is None else bisect.bisect_left(nums, (float(min_value),))
+        found = set()
+        for i in xrange(start, len(nums)):
+            if (max_value is not None) and (nums[i][0] > float(max_value)):
+                break
+            found.add(nums[i][1])
+        return found
+
+def _int_like(text):
+    try:
+        int(text)
+        return True
+    except ValueError:
+        return False
+
+def _int_text(text):
+    return _int_like(text) and (unicode(int(text)) == text)
+
+class MetadataTable(object):
+    """Columnar table of metagenome metadata, one typed column per (category, field):
+        mgids   : [ 'list', 'metagenome ids, row order of every column' ]
+        columns : { (category, field) : [ 'list', 'value per metagenome, None if missing' ] }
+        types   : { (category, field) : [ 'cv', ['int', 'float', 'str'] ] }
+    numeric fields are parsed once when the table is built, nan / inf values are missing (None).
+    """
+    def __init__(self, mgs=[]):
+        self.mgids   = map(lambda x: x.id, mgs)
+        self.columns = {}
+        self.types   = {}
+        raw = {}
+        for i, mg in enumerate(mgs):
+            metadata = getattr(mg, 'metadata', None) or {}
+            for cat in Ipy.MD_CATS:
+                if not (metadata.get(cat) and metadata[cat].get('data')):
+                    continue
+                for field, val in metadata[cat]['data'].iteritems():
+                    if (val is None) or (unicode(val).strip() == ''):
+                        continue
+                    key = (cat, field)
+                    if key not in raw:
+                        raw[key] = [None for x in self.mgids]
+                    raw[key][i] = val
+        for key, col in raw.iteritems():
+            self.types[key], self.columns[key] = self._typed_column(col)
+
+    def _typed_column(self, col):
+        # int only if every value reads back the same ('007' is an id, not 7), nan / inf are missing values
+        text = map(lambda x: None if x is None else unicode(x).strip(), col)
+        try:
+            nums = map(lambda x: None if x is None else float(x), text)
+        except (ValueError, TypeError):
+            return 'str', map(lambda x: None if x is None else unicode(x), col)
+        nums = map(lambda x: None if (x is None) or math.isnan(x) or math.isinf(x) else x, nums)
+        found = filter(lambda x: x[1] is not None, zip(text, nums))
+        if all(map(lambda x: _int_text(x[0]), found)):
+            return 'int', map(lambda x: None if x[1] is None else int(x[0]), zip(text, nums))
+        if any(map(lambda x: _int_like(x[0]) and (not _int_text(x[0])), found)):
+            return 'str', map(lambda x: None if x is None else unicode(x), col)
+        return 'float', nums
+
+    def keys(self, category=None):
+        """returns sorted list of (category, field) column keys, optionally of only one category"""
+        return sorted(filter(lambda x: (not category) or (x[0] == category), self.columns.keys()))
+
+    def values(self, category, field, ids=None):
+        """returns column values in order of ids (default all metagenomes), None where missing.
+        use ids=analysis.ids() to align metadata with the columns of an abundance matrix"""
+        col = self.columns.get((category, field))
+        if ids is None:
+            ids = self.mgids
+        if col is None:
+            return [None for x in ids]
+        pos = dict([(m, i) for i, m in enumerate(self.mgids)])
+        return map(lambda x: col[pos[x]] if x in pos else None, ids)
+
+    def groups(self, category, field, ids=None):
+        """returns dict: key = metadata value, value = list of metagenome ids with that value"""
+        if ids is None:
+            ids = self.mgids
+        groups = defaultdict(list)
+        for mid, val in zip(ids, self.values(category, field, ids)):
+            if val is not None:
+                groups[val].append(mid)
+        return dict(groups)
+
+    def groups_file(self, category, field, ids=None, fname=None):
+        """write tab-deliminated group labels in order of ids, as used by groups_file of R/do_stats.r"""
+        if not fname:
+            fname = Ipy.TMP_DIR+'/groups.'+random_str()+'.txt'
+        vals = self.values(category, field, ids)
+        fhdl = open(fname, 'w')
+        fhdl.write("\t".join(map(lambda x: 'NA' if x is None else unicode(x).encode('utf-8'), vals))+"\n")
+        fhdl.close()
+        return fname
+
+    def dump(self, fname=None, fformat='json'):
+        """Function for outputing the metadata table to flatfile or text string
+            fformat 'json': columnar json, { mgids: [...], columns: [{category, field, type, values}, ...] }
+            fformat 'tab' : tab-deliminated table, one row per metagenome, one column per category:field
+        """
+        keys = self.keys()
+        if fformat == 'json':
+            cols = map(lambda k: {'category': k[0], 'field': k[1], 'type': self.types[k], 'values': self.columns[k]}, keys)
+            output = json.dumps({'mgids': self.mgids, 'columns': cols}, separators=(',', ':'))
+        else:
+            rows = []
+            for i, mid in enumerate(self.mgids):
+                rows.append(map(lambda k: '' if self.columns[k][i] is None else unicode(self.columns[k][i]).encode('utf-8'), keys))
+            output = matrix_to_file(matrix=rows, cols=map(lambda k: k[0]+':'+k[1], keys), rows=self.mgids)
+        if fname:
+            open(fname, 'w').write(output)
+            return IPython.lib.display.FileLink(fname)
+        else:
+            return output
+
+    @classmethod
+    def load(cls, fname):
+        """create MetadataTable from file written with dump(fformat='json')"""
+        data = json.load(open(fname, 'rU'))
+        table = cls()
+        table.mgids = data['mgids']
+        for col in data['columns']:
+            key = (col['category'], col['field'])
+            table.types[key] = col['type']
+            table.columns[key] = col['values']
+        return table
@@ -1,9 +1,18 @@
 #!/usr/bin/env python
 
-import sys, os, json, traceback
+import sys, os, json, traceback, weakref
 import IPython.core.display
 from ipyTools import *
 
+def load_metagenomes(mgids=[], auth=None, cache=False, lazy=False, def_name=None):
+    """Load many Metagenome objects (without display) concurrently through API.
+    returns dict: key = metagenome_id, value = Metagenome() object
+    """
+    def load(mgid):
+        name = '%s["%s"]'%(def_name, mgid) if def_name else mgid
+        return Metagenome(mgid, display=False, auth=auth, def_name=name, cache=cache, lazy=lazy)
+    return dict(zip(mgids, map_concurrent(load, mgids)))
+
 class Metagenome(object):
     """Class representation of Metagenome object:
         "id"       : [ 'string', 'unique object identifier' ],
@@ -46,25 +55,41 @@ class Metagenome(object):
                        "source" : [ 'hash', 'evalue and % identity counts per source' ],
 	                   "rarefaction" : [ 'list', 'rarefaction coordinate data' ]
 	    "display"    : 'MetagenomeDisplay Object - help(this_name.display)'
+    
+    lazy=True loads only the metadata record, "statistics" is then a LazyStatistics object
+    that is fetched through API the first time it is accessed.
     """
-    def __init__(self, mgid, display=True, auth=None, def_name=None, cache=False):
+    def __init__(self, mgid, display=True, auth=None, def_name=None, cache=False, lazy=False):
         self._mgfile = Ipy.CCH_DIR+'/'+mgid+'.json'
+        self._mdfile = Ipy.CCH_DIR+'/'+mgid+'.metadata.json'
         self._auth   = auth
+        self._cache  = cache
         self.display = None
         metagenome   = None
         if cache and os.path.isfile(self._mgfile):
             # load from cache
             metagenome = self._load_cache('metagenome '+mgid, self._mgfile)
             print "Loading metagenome %s from cached file"%mgid
+        elif cache and lazy and os.path.isfile(self._mdfile):
+            # load metadata record from cache, statistics on demand
+            metagenome = self._load_cache('metagenome '+mgid, self._mdfile)
+            print "Loading metagenome %s from cached file"%mgid
+        if cache:
+            instrument.count('cache.metagenome.miss' if metagenome is None else 'cache.metagenome.hit')
         if metagenome is None:
             # load from api
-            metagenome = self._get_metagenome(mgid)
+            if lazy:
+                metagenome = self._get_metagenome(mgid, verbosity='metadata')
+            else:
+                metagenome = self._get_metagenome(mgid)
             print "Loading metagenome %s through API"%mgid
             if metagenome and cache and os.path.isdir(Ipy.CCH_DIR):
-                self._save_cache(metagenome, 'metagenome '+mgid, self._mgfile)
+                self._save_cache(metagenome, 'metagenome '+mgid, self._mdfile if lazy else self._mgfile)
         if metagenome is not None:
             for key, val in metagenome.iteritems():
                 setattr(self, key, val)
+            if lazy and ('statistics' not in metagenome):
+                self.statistics = LazyStatistics(self)
         else:
             sys.stderr.write("ERROR: unable to load metagenome %s through API\n"%mgid)
             self.id = mgid
@@ -82,6 +107,7 @@ class Metagenome(object):
         if display and metagenome:
             self.display = MetagenomeDisplay(self, self.defined_name+'.display')
     
+    @instrument.timed('Metagenome.load_cache')
     def _load_cache(self, ctype, cfile):
         # try load from cache if given
         obj = None
@@ -106,13 +132,223 @@ class Metagenome(object):
         mg_dict = {}
         for k, v in vars(self).items():
             if (not k.startswith('_')) and (k not in ['display','defined_name']):
-                mg_dict[k] = v
+                mg_dict[k] = v.todict() if isinstance(v, LazyStatistics) else v
         return mg_dict
     
-    def _get_metagenome(self, mgid):
+    @instrument.timed('Metagenome.fetch')
+    def _get_metagenome(self, mgid, verbosity='full'):
         if Ipy.DEBUG:
-            sys.stdout.write("Loading metagenome %s from API ...\n"%mgid)
-        return obj_from_url(Ipy.API_URL+'/metagenome/'+mgid+'?verbosity=full', self._auth)
+            sys.stdout.write("Loading metagenome %s (%s) from API ...\n"%(mgid, verbosity))
+        return obj_from_url(Ipy.API_URL+'/metagenome/'+mgid+'?verbosity='+verbosity, self._auth)
+    
+    def _get_statistics(self):
+        """fetch statistics for a metagenome loaded with lazy=True, update full cache file if caching"""
+        stats = self._get_metagenome(self.id, verbosity='stats')
+        if not (stats and ('statistics' in stats)):
+            sys.stderr.write("ERROR: unable to load statistics for metagenome %s through API\n"%self.id)
+            return None
+        if self._cache and os.path.isdir(Ipy.CCH_DIR):
+            full = self._mg_dict()
+            full['statistics'] = stats['statistics']
+            self._save_cache(full, 'metagenome '+self.id, self._mgfile)
+        return stats['statistics']
+
+# metagenomes sent to the page, to send again when the page asks for it
+_MG_OBJECTS = weakref.WeakValueDictionary()
+
+@instrument.timed('display.mg_data')
+def display_mg_data(mgs, view=None):
+    """Send metagenome data to the javascript store window.ipy_mg_data, keyed by metagenome id.
+    Only the fields needed for the given widget view are sent (see Ipy.MG_BASE and Ipy.MG_VIEWS),
+    and each field of a metagenome is sent at most once per notebook page.
+    Unknown views send the full metagenome record.
+
+    Sent fields are recorded per page token (Ipy.MG_SENT[Ipy.MG_PAGE]). A page whose token differs
+    from Ipy.MG_PAGE (reloaded, or opened in a second browser) asks the kernel to send the data again,
+    widgets wait for it through window.ipy_mg_when.
+    """
+    if view and (view not in Ipy.MG_VIEWS):
+        fields = None
+    else:
+        fields = Ipy.MG_BASE + (Ipy.MG_VIEWS[view] if view else [])
+    page_sent = Ipy.MG_SENT.setdefault(Ipy.MG_PAGE, {})
+    payload = {}
+    for mg in mgs:
+        _MG_OBJECTS[mg.id] = mg
+        sent = page_sent.setdefault(mg.id, set())
+        if fields is None:
+            if '*' not in sent:
+                payload[mg.id] = mg._mg_dict()
+                sent.update(['*'] + Ipy.MG_BASE + sum(Ipy.MG_VIEWS.values(), []))
+            continue
+        data = {}
+        for f in fields:
+            if ('*' in sent) or (f in sent):
+                continue
+            path = f.split('.')
+            val  = getattr(mg, path[0], None)
+            try:
+                for p in path[1:]:
+                    val = val[p]
+            except (KeyError, TypeError):
+                val = None
+            sent.add(f)
+            if val is None:
+                continue
+            curr = data
+            for p in path[:-1]:
+                curr = curr.setdefault(p, {})
+            curr[path[-1]] = val
+        if data:
+            payload[mg.id] = data
+    resend = "import sys; sys.modules[%s]._resend_mg_data("%json.dumps(__name__)
+    src = """
+        (function() {
+            var store = window.ipy_mg_data = window.ipy_mg_data || {};
+            if (! window.ipy_mg_page) {
+                window.ipy_mg_page = 'page_' + Math.random().toString(36).substr(2);
+                window.ipy_mg_pending = 0;
+                window.ipy_mg_queue = [];
+                // run func now, or after data requested from the kernel has arrived
+                window.ipy_mg_when = function(func) {
+                    if (window.ipy_mg_pending > 0) {
+                        window.ipy_mg_queue.push(func);
+                    } else {
+                        func();
+                    }
+                };
+            }
+            var ids = """+json.dumps(map(lambda x: x.id, mgs))+""";
+            for (var i = 0; i < ids.length; i++) {
+                // widgets keep a reference to the store object, data is merged into it
+                store[ids[i]] = store[ids[i]] || {};
+            }
+            if (window.ipy_mg_page != """+json.dumps(Ipy.MG_PAGE)+""") {
+                // kernel sent data to another page, ask for it again
+                var args = JSON.stringify({'page': window.ipy_mg_page, 'ids': ids, 'view': """+json.dumps(view)+"""});
+                var show = function(a, b) {
+                    var content = b || a.content;
+                    if (content && content.data && content.data['application/javascript']) {
+                        eval(content.data['application/javascript']);
+                    }
+                };
+                var done = function() {
+                    window.ipy_mg_pending -= 1;
+                    if (window.ipy_mg_pending == 0) {
+                        var queue = window.ipy_mg_queue;
+                        window.ipy_mg_queue = [];
+                        for (var q = 0; q < queue.length; q++) {
+                            queue[q]();
+                        }
+                    }
+                };
+                window.ipy_mg_pending += 1;
+                IPython.notebook.kernel.execute('"""+resend+"""' + JSON.stringify(args) + ')',
+                    { 'iopub': {'output': show}, 'shell': {'reply': done}, 'output': show, 'execute_reply': done },
+                    { 'silent': false, 'store_history': false });
+            }
+            var merge = function(a, b) {
+                for (var k in b) {
+                    if (b[k] && a[k] && (typeof b[k] == 'object') && !(b[k] instanceof Array)) {
+                        merge(a[k], b[k]);
+                    } else {
+                        a[k] = b[k];
+                    }
+                }
+                return a;
+            };
+            var data = """+json.dumps(payload, separators=(',', ':'))+""";
+            for (var id in data) {
+                store[id] = merge(store[id] || {}, data[id]);
+            }
+        })();
+        """
+    IPython.core.display.display_javascript(IPython.core.display.Javascript(data=src))
+
+def _resend_mg_data(args):
+    """called from a page with args json {'page', 'ids', 'view'}: make page the current one and send it the data"""
+    args = json.loads(args)
+    Ipy.MG_PAGE = args['page']
+    mgs = filter(lambda x: x is not None, map(lambda x: _MG_OBJECTS.get(x), args['ids']))
+    display_mg_data(mgs, args['view'])
+
+class LazyStatistics(dict):
+    """Proxy for Metagenome.statistics when loaded with lazy=True:
+    statistics (qc, rarefaction, sequence_stats, taxonomy, ontology, ...) are fetched
+    through API the first time a section not yet loaded is accessed.
+    """
+    def __init__(self, mg, data={}):
+        dict.__init__(self, data)
+        self._mg = mg
+        self._loaded = False
+    
+    def __reduce__(self):
+        return (LazyStatistics, (self._mg, dict(self)), {'_loaded': self._loaded})
+    
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        stats = self._mg._get_statistics()
+        if stats:
+            dict.update(self, stats)
+    
+    def todict(self):
+        self._load()
+        return dict(self)
+    
+    def __getitem__(self, key):
+        if not dict.__contains__(self, key):
+            self._load()
+        return dict.__getitem__(self, key)
+    
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self._load()
+        return dict.__contains__(self, key)
+    
+    def has_key(self, key):
+        return self.__contains__(key)
+    
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+    
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+    
+    def __repr__(self):
+        if not self._loaded:
+            return "<LazyStatistics for metagenome %s, not loaded>"%self._mg.id
+        return dict.__repr__(self)
+    
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+    
+    def values(self):
+        self._load()
+        return dict.values(self)
+    
+    def items(self):
+        self._load()
+        return dict.items(self)
+    
+    def iterkeys(self):
+        self._load()
+        return dict.iterkeys(self)
+    
+    def itervalues(self):
+        self._load()
+        return dict.itervalues(self)
+    
+    def iteritems(self):
+        self._load()
+        return dict.iteritems(self)
 
 class MetagenomeDisplay(object):
     """Class containing functions to display metagenome visualizations:
@@ -138,15 +374,18 @@ class MetagenomeDisplay(object):
             except:
                 pass
         self.defined_name = def_name
-        # load and create instance of metagenome widget
+        # load and create instance of metagenome widget, data is sent per view
         self._mg_widget = 'window.mg_widget_'+random_str();
         self._widget_div = 'mg_div_'+random_str();
+        display_mg_data([self.mg])
         html = "<div id='%s'></div>"%self._widget_div
         src = """
         (function() {
             Retina.load_widget("metagenome_overview").then( function() {
                 """+self._mg_widget+""" = Retina.Widget.create('metagenome_overview', {'target': document.getElementById('"""+self._widget_div+"""')}, true);
-                """+self._mg_widget+""".curr_mg = """+json.dumps(self.mg._mg_dict())+""";
+                window.ipy_mg_when(function() {
+                    """+self._mg_widget+""".curr_mg = window.ipy_mg_data["""+json.dumps(self.mg.id)+"""];
+                });
             });
 		})();
         """
@@ -203,18 +442,21 @@ class MetagenomeDisplay(object):
     
     def summary_chart(self, arg_list=False, target=None):
         try:
+            display_mg_data([self.mg], 'summary_chart')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='summary_chart', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing summary chart\n")
     
     def summary_stats(self, arg_list=False, target=None):
         try:
+            display_mg_data([self.mg], 'summary_stats')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='summary_stats', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing summary stats\n")
             
     def annotation_chart(self, annotation='organism', level='domain', source='Subsystems', arg_list=False, target=None):
         try:
+            display_mg_data([self.mg], 'annotation_chart')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='annotation_chart', annotation=annotation, level=level, source=source, arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing annotation chart\n")
@@ -224,6 +466,7 @@ class MetagenomeDisplay(object):
             sys.stderr.write("Unable to display bp histogram graph for Amplicon datasets.\n")
             return
         try:
+            display_mg_data([self.mg], 'bp_histogram')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='bp_histogram', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing bp histogram\n")
@@ -233,6 +476,7 @@ class MetagenomeDisplay(object):
             sys.stderr.write("Unable to display drisee plot for Amplicon datasets.\n")
             return
         try:
+            display_mg_data([self.mg], 'drisee')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='drisee', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing drisee plot\n")
@@ -242,18 +486,21 @@ class MetagenomeDisplay(object):
             sys.stderr.write("Unable to display kmer profile for Amplicon datasets.\n")
             return
         try:
+            display_mg_data([self.mg], 'kmer')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='kmer', kmer=kmer, arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing kmer plot\n")
             
     def rarefaction(self, arg_list=False, target=None):
         try:
+            display_mg_data([self.mg], 'rarefaction')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='rarefaction', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing rarefaction plot\n")
             
     def rank_abundance(self, level='domain', arg_list=False, target=None):
         try:
+            display_mg_data([self.mg], 'rank_abundance')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='rank_abundance', level=level, arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing rank abundance plot\n")
@@ -263,6 +510,7 @@ class MetagenomeDisplay(object):
             sys.stderr.write("No MIxS metadata available to display.\n")
             return
         try:
+            display_mg_data([self.mg], 'mixs')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='mixs', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing mixs metadata table\n")
@@ -272,6 +520,7 @@ class MetagenomeDisplay(object):
             sys.stderr.write("No metadata available to display.\n")
             return
         try:
+            display_mg_data([self.mg], 'metadata')
             Ipy.RETINA.metagenome(widget=self._mg_widget, view='metadata', arg_list=arg_list, target=target)
         except:
             sys.stderr.write("Error producing full metadata table\n")
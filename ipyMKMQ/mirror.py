@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import sys, json, sqlite3, threading
+from ipyTools import *
+from rpc import RPCClient
+
+class CDMIMirror(object):
+    """Local SQLite mirror of mostly static CDMI_API id mappings:
+        one table per method in self.methods, key = input id, value = json of service result for that id
+        (null if service had no result, so misses are not asked again)
+
+    get(method, ids)          : returns ({ id : value } found in mirror, [ ids not in mirror ])
+    put(method, mapping, ids) : store { id : value } results, ids missing from mapping are stored as null
+    load(method, ids, api)    : bulk-load ids from service (chunked, concurrent) into mirror
+    """
+    methods = ['fids_to_functions', 'fids_to_roles', 'roles_to_subsystems', 'genomes_to_taxonomies', 'fids_to_protein_families']
+
+    def __init__(self, fname=None):
+        if not fname:
+            fname = Ipy.CCH_DIR+'/cdmi_mirror.sqlite'
+        try:
+            if not cache_path(fname):
+                raise sqlite3.OperationalError("can not create directory %s"%os.path.dirname(fname))
+            self._db = sqlite3.connect(fname, check_same_thread=False)
+        except sqlite3.OperationalError as e:
+            sys.stderr.write("Error opening %s (%s), mirror is kept in memory\n"%(fname, e))
+            fname = ':memory:'
+            self._db = sqlite3.connect(fname, check_same_thread=False)
+        self.fname = fname
+        self._lock = threading.Lock()
+        for m in self.methods:
+            self._db.execute("CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, value TEXT)"%m)
+        self._db.commit()
+
+    def _check(self, method):
+        if method not in self.methods:
+            raise ValueError("method '%s' is not mirrored, use one of: %s"%(method, ", ".join(self.methods)))
+
+    def get(self, method, ids):
+        self._check(method)
+        found = {}
+        seen  = set()
+        ids   = list(set(ids))
+        with self._lock:
+            for i in xrange(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                sql = "SELECT id, value FROM %s WHERE id IN (%s)"%(method, ",".join('?' for x in chunk))
+                for key, val in self._db.execute(sql, chunk):
+                    seen.add(key)
+                    if val != 'null':
+                        found[key] = json.loads(val)
+        instrument.count('cache.mirror.hit', len(seen))
+        instrument.count('cache.mirror.miss', len(ids) - len(seen))
+        return found, filter(lambda x: x not in seen, ids)
+
+    def put(self, method, mapping, ids=[]):
+        self._check(method)
+        rows = map(lambda x: (x[0], json.dumps(x[1])), mapping.iteritems())
+        rows.extend( map(lambda x: (x, 'null'), filter(lambda y: y not in mapping, ids)) )
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO %s (id, value) VALUES (?, ?)"%method, rows)
+            self._db.commit()
+
+    def load(self, method, ids, api, chunk_size=1000):
+        """fetch ids not yet in mirror from CDMI_API service and store them, returns number fetched"""
+        found, missing = self.get(method, ids)
+        if missing:
+            rpc = api if isinstance(api, RPCClient) else RPCClient(api, chunk_size=chunk_size)
+            self.put(method, rpc.scatter(method, missing), missing)
+        return len(missing)
+
+    def count(self, method):
+        self._check(method)
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM %s"%method).fetchone()[0]
+
+class MirroredCDMI(object):
+    """CDMI_API client that answers mirrored methods (see CDMIMirror.methods) from a local CDMIMirror first,
+    only ids missing from the mirror are sent to the service and then added to the mirror.
+    offline=True never calls the service for mirrored methods.
+    all other CDMI_API methods are passed through to the service.
+
+    cdmi = MirroredCDMI(cdmi.CDMI_API(Ipy.CDMI_URL))
+    cdmi.fids_to_functions(fids)
+    """
+    def __init__(self, api, mirror=None, offline=False, chunk_size=1000):
+        self.api = api
+        self.rpc = api if isinstance(api, RPCClient) else RPCClient(api, chunk_size=chunk_size)
+        self.mirror = mirror if mirror else CDMIMirror()
+        self.offline = offline
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in CDMIMirror.methods:
+            return lambda ids: self._lookup(name, ids)
+        return getattr(self.api, name)
+
+    def _lookup(self, method, ids):
+        found, missing = self.mirror.get(method, ids)
+        if missing and (not self.offline):
+            if Ipy.DEBUG:
+                sys.stdout.write("%s: %d from mirror, %d from service\n"%(method, len(found), len(missing)))
+            fetched = self.rpc.scatter(method, missing)
+            self.mirror.put(method, fetched, missing)
+            found.update(fetched)
+        return found
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""Memory-mapped BIOM matrices.
+
+A BIOM json file is split into a binary file of the dense matrix values (row major, native byte order)
+and a sidecar json file with everything else (rows, columns, type, ..) and the layout of the binary file:
+
+    <name>.mmap       : rows x columns values, array typecode 'i' (int counts) or 'd'
+    <name>.mmap.json  : BIOM object without 'data', plus 'mmap': {'file', 'typecode', 'itemsize', 'byteorder', 'shape'}
+
+Opening one only parses the sidecar; matrix values are read from the mapped file on access, whole rows
+or strided columns at a time, so all kernels on a host reading the same file share one copy in the page cache.
+
+    python mmatrix.py biom_dir [out_dir]
+"""
+
+import sys, os, json, mmap, array, glob, argparse
+
+SUFFIX = '.mmap'
+INT_MAX = 2 ** 31 - 1
+
+def _typecode(biom):
+    """'i' for int matrices that fit in 32 bits, else 'd'"""
+    if biom['matrix_type'] == 'dense':
+        values = (v for row in biom['data'] for v in row)
+    else:
+        values = (x[2] for x in biom['data'])
+    for v in values:
+        if (not isinstance(v, (int, long))) or (abs(v) > INT_MAX):
+            return 'd'
+    return 'i'
+
+def biom_to_mapped(biom, fname):
+    """write BIOM object as fname (binary values) and fname.json (sidecar), returns sidecar file name.
+    both are written to temp names and renamed, readers never see half written files"""
+    rows, cols = biom['shape']
+    code = _typecode(biom)
+    tmp  = fname+'.tmp%d'%os.getpid()
+    # exclusive create, do not follow a link planted at tmp in a shared directory
+    fhdl = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644), 'wb')
+    if biom['matrix_type'] == 'dense':
+        for row in biom['data']:
+            array.array(code, row).tofile(fhdl)
+    else:
+        # one sparse row at a time, data is not sorted
+        by_row = {}
+        for r, c, v in biom['data']:
+            by_row.setdefault(r, []).append((c, v))
+        for r in xrange(rows):
+            row = array.array(code, [0]) * cols
+            for c, v in by_row.get(r, []):
+                row[c] = v
+            row.tofile(fhdl)
+    fhdl.close()
+    side = dict([(k, v) for k, v in biom.iteritems() if k != 'data'])
+    side['matrix_type'] = 'dense'
+    side['mmap'] = { 'file': os.path.basename(fname),
+                     'typecode': code,
+                     'itemsize': array.array(code).itemsize,
+                     'byteorder': sys.byteorder,
+                     'shape': [rows, cols] }
+    shdl = os.fdopen(os.open(tmp+'.json', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644), 'w')
+    json.dump(side, shdl, separators=(',', ':'))
+    shdl.close()
+    os.rename(tmp, fname)
+    os.rename(tmp+'.json', fname+'.json')
+    return fname+'.json'
+
+def convert_biom_dir(biom_dir, out_dir=None, force=False):
+    """convert every <name>.biom in biom_dir to <name>.mmap and <name>.mmap.json in out_dir (default biom_dir).
+    files newer than their .biom are skipped unless force. returns list of sidecar files"""
+    if not out_dir:
+        out_dir = biom_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    done = []
+    for bfile in sorted(glob.glob(os.path.join(biom_dir, '*.biom'))):
+        name  = os.path.basename(bfile)[:-5]
+        mfile = os.path.join(out_dir, name+SUFFIX)
+        if (not force) and os.path.isfile(mfile+'.json') and (os.path.getmtime(mfile+'.json') >= os.path.getmtime(bfile)):
+            done.append(mfile+'.json')
+            continue
+        try:
+            biom = json.load(open(bfile, 'rU'))
+        except ValueError:
+            sys.stderr.write("Error: %s is not valid json, skipping\n"%bfile)
+            continue
+        done.append( biom_to_mapped(biom, mfile) )
+    return done
+
+class MappedMatrix(object):
+    """read-only rows x columns matrix backed by a memory-mapped .mmap file, indexed like a list of rows:
+        m[i]         : array of row i, read in one copy from the mapped file (m[i][j] value)
+        len(m)       : number of rows
+        iter(m)      : arrays of all rows, read in blocks
+        m.column(j)  : array of column j
+        m.columns()  : list of arrays of all columns, in one pass over the file
+        m.tolist()
+    pickles as its file name, the file is mapped again on unpickling"""
+    BLOCK = 1 << 22 # bytes read per block by iter / column / columns
+
+    def __init__(self, fname, typecode, shape):
+        self.fname = fname
+        self.typecode = typecode
+        self.shape = tuple(shape)
+        self._open()
+
+    def _open(self):
+        self.itemsize = array.array(self.typecode).itemsize
+        self._rowsize = self.shape[1] * self.itemsize
+        size = self.shape[0] * self._rowsize
+        if os.path.getsize(self.fname) != size:
+            raise ValueError("%s has %d bytes, expected %d for shape %s"%(self.fname, os.path.getsize(self.fname), size, self.shape))
+        fhdl = open(self.fname, 'rb')
+        # mmap can not map empty files
+        self._buf = mmap.mmap(fhdl.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        fhdl.close()
+
+    def __getstate__(self):
+        return {'fname': self.fname, 'typecode': self.typecode, 'shape': self.shape}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return map(self.__getitem__, xrange(*index.indices(self.shape[0])))
+        if index < 0:
+            index += self.shape[0]
+        if (index < 0) or (index >= self.shape[0]):
+            raise IndexError("matrix index out of range")
+        offset = index * self._rowsize
+        return array.array(self.typecode, self._buf[offset:offset + self._rowsize])
+
+    def _blocks(self):
+        """yields arrays of whole rows, about BLOCK bytes each"""
+        step = max(1, self.BLOCK / max(self._rowsize, 1)) * self._rowsize
+        for offset in xrange(0, self.shape[0] * self._rowsize, step):
+            yield array.array(self.typecode, self._buf[offset:offset + step])
+
+    def __iter__(self):
+        cols = self.shape[1]
+        for block in self._blocks():
+            for i in xrange(0, len(block), cols):
+                yield block[i:i + cols]
+
+    def column(self, index):
+        if index < 0:
+            index += self.shape[1]
+        if (index < 0) or (index >= self.shape[1]):
+            raise IndexError("column index out of range")
+        col = array.array(self.typecode)
+        for block in self._blocks():
+            col.extend(block[index::self.shape[1]])
+        return col
+
+    def columns(self):
+        cols = map(lambda x: array.array(self.typecode), xrange(self.shape[1]))
+        for block in self._blocks():
+            for j in xrange(self.shape[1]):
+                cols[j].extend(block[j::self.shape[1]])
+        return cols
+
+    def tolist(self):
+        return map(lambda x: x.tolist(), self)
+
+def open_mapped(fname):
+    """returns BIOM object from sidecar json fname (or its .mmap file), with 'data' as MappedMatrix.
+    the .mmap file must be in the same directory as the sidecar"""
+    if not fname.endswith('.json'):
+        fname += '.json'
+    biom = json.load(open(fname, 'rU'))
+    info = biom.pop('mmap')
+    if (info['file'] != os.path.basename(info['file'])) or (info['file'] in ('', '.', '..')) or (os.sep in info['file']):
+        raise ValueError("%s has invalid mmap file name %r, expected a file in the same directory"%(fname, info['file']))
+    if info['byteorder'] != sys.byteorder:
+        raise ValueError("%s was written on a %s endian host"%(fname, info['byteorder']))
+    if array.array(info['typecode']).itemsize != info['itemsize']:
+        raise ValueError("%s has %d byte values, this host uses %d"%(fname, info['itemsize'], array.array(info['typecode']).itemsize))
+    biom['data'] = MappedMatrix(os.path.join(os.path.dirname(fname), info['file']), info['typecode'], info['shape'])
+    return biom
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="convert a directory of BIOM json files to memory-mapped matrix files")
+    parser.add_argument('biom_dir', help="directory of .biom files")
+    parser.add_argument('out_dir', nargs='?', default=None, help="output directory, default biom_dir")
+    parser.add_argument('--force', action='store_true', help="convert files that are already up to date")
+    args = parser.parse_args()
+    for f in convert_biom_dir(args.biom_dir, args.out_dir, args.force):
+        print f
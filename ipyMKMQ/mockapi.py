@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the MG-RAST API and the KBase JSON-RPC services, for offline load testing.
+
+    mock = MockAPI(latency=0.05, failure_rate=0.01).start()
+    mock.use()       # point Ipy.API_URL and all service urls at the mock
+    ... notebook code ...
+    print load_report(load_test(NOTEBOOK_PATTERNS['collection'], concurrency=8, repeat=20))
+    mock.stop()      # restores urls
+"""
+
+import sys, os, random, threading, urlparse, copy
+import BaseHTTPServer, SocketServer
+from ipyTools import *
+from benchmark import synthetic_biom
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping connections are expected under load, only report when debugging
+        if Ipy.DEBUG:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        if Ipy.DEBUG:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def _send(self, code, obj):
+        mock = self.server.mock
+        body = json.dumps(obj, separators=(',', ':'))
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # bandwidth limit: send in chunks, sleeping for the time each chunk takes at that rate
+        step = 65536
+        for i in xrange(0, len(body), step):
+            chunk = body[i:i+step]
+            if mock.bandwidth:
+                sleep(len(chunk) / float(mock.bandwidth))
+            self.wfile.write(chunk)
+        mock._count(self.path, len(body))
+
+    def _inject(self):
+        mock = self.server.mock
+        delay = mock.latency + (mock._rand.random() * mock.jitter if mock.jitter else 0)
+        if delay:
+            sleep(delay)
+        if mock.failure_rate and (mock._rand.random() < mock.failure_rate):
+            return True
+        return False
+
+    def do_GET(self):
+        if self._inject():
+            return self._send(500, {'ERROR': 'injected failure'})
+        code, obj = self.server.mock.get(self.path)
+        self._send(code, obj)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self._inject():
+            return self._send(500, {'version': '1.1', 'error': {'name': 'JSONRPCError', 'code': -32603, 'message': 'injected failure'}})
+        try:
+            req = json.loads(body)
+        except ValueError:
+            return self._send(500, {'version': '1.1', 'error': {'name': 'JSONRPCError', 'code': -32700, 'message': 'parse error'}})
+        mock = self.server.mock
+        if isinstance(req, list):
+            if not mock.batch:
+                return self._send(500, {'version': '1.1', 'error': {'name': 'JSONRPCError', 'code': -32600, 'message': 'batch not supported'}})
+            return self._send(200, map(mock.rpc, req))
+        resp = mock.rpc(req)
+        self._send(500 if 'error' in resp else 200, resp)
+
+class MockAPI(object):
+    """Threaded local HTTP server answering:
+        GET  /metagenome/<id>?verbosity=   synthetic metagenome (metadata, stats or full)
+        GET  /project/<id>                 synthetic project with 'analyzed' metagenomes
+        GET  /matrix/<annotation>?id=..    synthetic sparse BIOM for the requested ids
+        GET  /m5nr/<taxonomy|ontology>     synthetic hierarchy
+        POST any path                      JSON-RPC 1.1 (single or batch) for the KBase clients
+    canned responses take precedence: canned[path with query] or canned[path] = object,
+    rpc_handlers['Service.method'] = function(params) returning the result.
+    unknown rpc methods with an id list first param return { id : '<method> <id>' }.
+    latency (+ random jitter) seconds per request, bandwidth in bytes per second, failure_rate 0 - 1.
+    stats: { 'requests', 'bytes', 'paths': { path : count } }
+    """
+    def __init__(self, port=0, latency=0, jitter=0, bandwidth=None, failure_rate=0, batch=True, mg_count=20, seed=0):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.batch = batch
+        self.mg_count = mg_count
+        self.canned = {}
+        self.rpc_handlers = {}
+        self.stats = {'requests': 0, 'bytes': 0, 'paths': {}}
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._saved = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d'%self._server.server_address[1]
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', self.port), _Handler)
+        self._server.mock = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.restore()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def use(self):
+        """point Ipy.API_URL and the KBase service urls at this server"""
+        names = ['API_URL', 'CDMI_URL', 'NETWORKS_URL', 'GENOPHENO_URL', 'ONTOLOGY_URL', 'EXPRESSION_URL']
+        if self._saved is None:
+            self._saved = dict([(n, getattr(Ipy, n, None)) for n in names])
+        for n in names:
+            setattr(Ipy, n, self.url)
+        return self
+
+    def restore(self):
+        if self._saved is not None:
+            for n, v in self._saved.iteritems():
+                setattr(Ipy, n, v)
+            self._saved = None
+
+    def load_canned(self, cdir):
+        """load canned responses from json files in cdir, file name is the path with '/' replaced by '__'"""
+        for fname in os.listdir(cdir):
+            if fname.endswith('.json'):
+                path = '/'+fname[:-5].replace('__', '/')
+                self.canned[path] = json.load(open(os.path.join(cdir, fname), 'rU'))
+
+    def _count(self, path, size):
+        with self._lock:
+            key = path.split('?')[0]
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+            self.stats['paths'][key] = self.stats['paths'].get(key, 0) + 1
+
+    def get(self, path):
+        """returns (http code, object) for GET path"""
+        if path in self.canned:
+            return 200, copy.deepcopy(self.canned[path])
+        parts = urlparse.urlparse(path)
+        if parts.path in self.canned:
+            return 200, copy.deepcopy(self.canned[parts.path])
+        query = urlparse.parse_qs(parts.query)
+        names = filter(None, parts.path.split('/'))
+        if len(names) < 2:
+            return 404, {'ERROR': 'resource not found'}
+        rtype, rid = names[-2], names[-1]
+        if rtype == 'metagenome':
+            return 200, self.metagenome(rid, query.get('verbosity', ['minimal'])[0])
+        if rtype == 'project':
+            return 200, self.project(rid)
+        if rtype == 'matrix':
+            return 200, self.matrix(rid, query.get('id', []))
+        if rtype == 'm5nr':
+            return 200, self.hierarchy(rid)
+        return 404, {'ERROR': 'resource not found'}
+
+    def metagenome(self, mgid, verbosity='full'):
+        rand = random.Random(mgid)
+        mg = { 'id': mgid, 'name': 'mock '+mgid, 'sequence_type': 'WGS', 'status': 'public', 'version': 1,
+               'created': '2000-01-01 00:00:00', 'url': self.url+'/metagenome/'+mgid,
+               'project': ['mgp1', self.url+'/project/mgp1'], 'library': ['mgl'+mgid, ''], 'sample': ['mgs'+mgid, ''] }
+        if verbosity in ('metadata', 'full'):
+            mg['metadata'] = dict([(c, {'id': c+mgid, 'data': {'biome': 'biome %d'%rand.randint(1, 5), 'depth': str(rand.randint(1, 100))}}) for c in Ipy.MD_CATS])
+            mg['mixs'] = {'biome': mg['metadata']['sample']['data']['biome'], 'country': 'mock'}
+        if verbosity in ('stats', 'full'):
+            nseq = rand.randint(10000, 1000000)
+            mg['statistics'] = {
+                'sequence_stats': {'sequence_count_raw': str(nseq), 'bp_count_raw': str(nseq * 150), 'alpha_diversity_shannon': str(rand.uniform(10, 500))},
+                'rarefaction': [ [i, int(1000 * (1 - math.exp(-i / float(nseq / 5))))] for i in xrange(0, nseq, nseq / 100) ],
+                'qc': { 'drisee': {'counts': {'columns': ['#', 'A', 'T', 'C', 'G', 'N', 'InDel', 'Total'], 'data': [[i]+[rand.random() for j in range(7)] for i in range(1, 101)]}},
+                        'bp_profile': {'counts': {'columns': ['#', 'A', 'T', 'C', 'G', 'N'], 'data': [[i]+[rand.randint(0, 1000) for j in range(5)] for i in range(1, 101)]}},
+                        'kmer': {'15_mer': {'columns': ['count of identical kmers of size N', 'number of times count occures', 'product of column 1 and 2', 'reverse sum of column 2', 'reverse sum of column 3', 'ratio of column 5 to total sum column 3 (not reverse)'],
+                                            'data': [[i, rand.randint(1, 10000), 0, 0, 0, rand.random()] for i in range(1, 101)]}} },
+                'taxonomy': dict([(l, [['%s_%d'%(l, i), rand.randint(1, 1000)] for i in range(10)]) for l in ['domain', 'phylum', 'class', 'order', 'family', 'genus']]),
+                'ontology': dict([(s, [['level1_%d'%i, rand.randint(1, 1000)] for i in range(10)]) for s in ['COG', 'KO', 'NOG', 'Subsystems']]),
+                'length_histogram': {'upload': [], 'post_qc': []},
+                'gc_histogram': {'upload': [], 'post_qc': []} }
+        return mg
+
+    def project(self, pid):
+        return { 'id': pid, 'name': 'mock project '+pid, 'status': 'public', 'version': 1,
+                 'analyzed': [ ['mgm%d.3'%i, 'mock metagenome %d'%i, '0', self.url+'/metagenome/mgm%d.3'%i] for i in xrange(self.mg_count) ] }
+
+    def matrix(self, annotation, ids, rows=500, density=0.2):
+        biom = synthetic_biom(rows, len(ids), density, seed=len(ids))
+        biom['id'] = '_'.join(ids)
+        biom['type'] = ('Taxon' if annotation == 'organism' else 'Function')+' table'
+        biom['columns'] = map(lambda x: {'id': x, 'name': 'mock '+x, 'metadata': None}, ids)
+        if annotation != 'organism':
+            for r in biom['rows']:
+                r['metadata'] = {'ontology': r['metadata']['taxonomy']}
+        return biom
+
+    def hierarchy(self, htype):
+        levels = Ipy.TAX_SET if htype == 'taxonomy' else Ipy.ONT_SET
+        data = []
+        for i in xrange(256):
+            # each level splits its parent in two
+            data.append(dict([(l, '%s_%d'%(l, i >> (len(levels) - 1 - n))) for n, l in enumerate(levels)]))
+        return {'data': data}
+
+    def rpc(self, req):
+        method = req.get('method', '')
+        params = req.get('params', [])
+        resp = {'version': '1.1', 'id': req.get('id')}
+        try:
+            if method in self.rpc_handlers:
+                result = self.rpc_handlers[method](params)
+            elif params and isinstance(params[0], list):
+                name = method.split('.')[-1]
+                result = dict([(x, '%s %s'%(name, x)) for x in params[0]])
+            else:
+                result = []
+            resp['result'] = [result]
+        except Exception as e:
+            resp['error'] = {'name': 'JSONRPCError', 'code': -32603, 'message': str(e)}
+        return resp
+
+# notebook style access patterns: list of ('GET', path) or ('RPC', 'Service.method', params)
+NOTEBOOK_PATTERNS = {
+    'collection': [('GET', '/project/mgp1?verbosity=full')] + [('GET', '/metagenome/mgm%d.3?verbosity=metadata'%i) for i in range(10)] + [('GET', '/metagenome/mgm%d.3?verbosity=stats'%i) for i in range(10)],
+    'analysis': [('GET', '/matrix/organism?'+'&'.join(['id=mgm%d.3'%i for i in range(10)])), ('GET', '/m5nr/taxonomy?version=1&min_level=species')],
+    'cdmi': [('RPC', 'CDMI_API.fids_to_functions', [['kb|g.0.peg.%d'%i for i in range(j, j+100)]]) for j in range(0, 1000, 100)]
+}
+
+def _replay(base, pattern):
+    """run one pattern against server at base url, returns list of (seconds, ok)"""
+    times = []
+    for step in pattern:
+        stime = time()
+        ok = True
+        try:
+            if step[0] == 'GET':
+                res = urllib2.urlopen(base+step[1])
+                res.read()
+            else:
+                body = json.dumps({'method': step[1], 'params': step[2], 'version': '1.1', 'id': '1'})
+                res = urllib2.urlopen(base, body)
+                res.read()
+        except (urllib2.URLError, IOError):
+            ok = False
+        times.append((time() - stime, ok))
+    return times
+
+def load_test(pattern, concurrency=8, repeat=10, base=None):
+    """replay pattern 'repeat' times with 'concurrency' concurrent sessions.
+    pattern is a list of steps (see NOTEBOOK_PATTERNS) sent to base (default Ipy.API_URL),
+    or a function run once per repeat, ie. lambda: load_metagenomes(ids) to include the library's own work.
+    returns { 'requests', 'errors', 'seconds', 'throughput', 'p50', 'p95', 'p99', 'max' }"""
+    from multiprocessing.pool import ThreadPool
+    base = base if base else Ipy.API_URL
+    if callable(pattern):
+        def run(i):
+            stime = time()
+            try:
+                pattern()
+                return [(time() - stime, True)]
+            except Exception:
+                return [(time() - stime, False)]
+    else:
+        run = lambda i: _replay(base, pattern)
+    pool  = ThreadPool(concurrency)
+    stime = time()
+    times = sum(pool.map(run, range(repeat), chunksize=1), [])
+    total = time() - stime
+    pool.close()
+    lat = sorted(map(lambda x: x[0], times))
+    pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] if lat else 0
+    return { 'requests': len(times),
+             'errors': len(filter(lambda x: not x[1], times)),
+             'seconds': total,
+             'throughput': len(times) / total if total else 0,
+             'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99), 'max': lat[-1] if lat else 0 }
+
+def load_report(result):
+    return "requests %d, errors %d, %.2f sec, %.1f req/sec, latency p50 %.3f p95 %.3f p99 %.3f max %.3f"%(
+        result['requests'], result['errors'], result['seconds'], result['throughput'], result['p50'], result['p95'], result['p99'], result['max'])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import sys
+from ipyTools import *
+import networks
+
+class NetworkStore(object):
+    """Client-side cache of KBaseNetworks first neighbor networks, kept per (dataset id, edge type).
+    network node ids differ between service calls, so nodes and edges are keyed by node entityId:
+        nodes    : { entity id : node dict, 'id' set to entity id }
+        edges    : { (dataset id, edge type) : { (entity id 1, entity id 2) : edge dict, nodeId1 / nodeId2 set to entity ids } }
+        expanded : { (dataset id, edge type) : set of entity ids whose neighbors are loaded }
+    only entities not yet expanded are sent to the service, strength cutoffs are applied on cached edges.
+    returned networks have the same 'nodes' / 'edges' layout as the service networks.
+
+    store = NetworkStore()
+    net = store.neighbors(['kb|netdataset.ppi.7'], ['kb|g.3899.CDS.1'], ['GENE_GENE'], cutoff=0.5)
+    net = store.neighbors(['kb|netdataset.ppi.7'], ['kb|g.3899.CDS.1', 'kb|g.3899.CDS.2'], ['GENE_GENE'])  # only CDS.2 is fetched
+    """
+    def __init__(self, api=None):
+        self.api = api if api else networks.KBaseNetworks(Ipy.NETWORKS_URL)
+        self.nodes = {}
+        self.edges = {}
+        self.expanded = {}
+
+    def _load(self, dataset_ids, entity_ids, edge_types):
+        todo = []
+        for key in [(d, t) for d in dataset_ids for t in edge_types]:
+            done = self.expanded.setdefault(key, set())
+            self.edges.setdefault(key, {})
+            missing = sorted(filter(lambda x: x not in done, set(entity_ids)))
+            if missing:
+                todo.append((key, missing))
+        if not todo:
+            return
+        if Ipy.DEBUG:
+            sys.stdout.write("fetching neighbors of %d entities\n"%sum(map(lambda x: len(x[1]), todo)))
+        nets = map_concurrent(lambda x: self.api.buildFirstNeighborNetwork([x[0][0]], x[1], [x[0][1]]), todo)
+        for (key, missing), net in zip(todo, nets):
+            self._add(key, net)
+            self.expanded[key].update(missing)
+
+    def _add(self, key, net):
+        ids = {}
+        for node in net.get('nodes', []):
+            eid = node.get('entityId') or node['id']
+            ids[node['id']] = eid
+            if eid not in self.nodes:
+                node = dict(node)
+                node['id'] = eid
+                self.nodes[eid] = node
+        edges = self.edges[key]
+        for edge in net.get('edges', []):
+            edge = dict(edge)
+            edge['nodeId1'] = ids.get(edge['nodeId1'], edge['nodeId1'])
+            edge['nodeId2'] = ids.get(edge['nodeId2'], edge['nodeId2'])
+            edges[(edge['nodeId1'], edge['nodeId2'])] = edge
+
+    def _network(self, edges):
+        nodes = set()
+        for edge in edges:
+            nodes.update([edge['nodeId1'], edge['nodeId2']])
+        return { 'nodes': map(lambda x: self.nodes.get(x, {'id': x, 'entityId': x}), sorted(nodes)), 'edges': edges }
+
+    def _edges(self, dataset_ids, edge_types, cutoff=None, test=None):
+        found = []
+        for key in [(d, t) for d in dataset_ids for t in edge_types]:
+            for pair, edge in self.edges.get(key, {}).iteritems():
+                if (cutoff is not None) and (edge.get('strength', 0) < cutoff):
+                    continue
+                if (test is None) or test(pair):
+                    found.append(edge)
+        return found
+
+    def neighbors(self, dataset_ids, entity_ids, edge_types, cutoff=None):
+        """first neighbor network of entity_ids, same as buildFirstNeighborNetwork
+        (or buildFirstNeighborNetworkLimtedByStrength with cutoff)"""
+        self._load(dataset_ids, entity_ids, edge_types)
+        ids = set(entity_ids)
+        return self._network( self._edges(dataset_ids, edge_types, cutoff, lambda p: (p[0] in ids) or (p[1] in ids)) )
+
+    def internal(self, dataset_ids, gene_ids, edge_types, cutoff=None):
+        """network of edges between gene_ids only, same as buildInternalNetwork
+        (or buildInternalNetworkLimitedByStrength with cutoff). genes not yet expanded are expanded first"""
+        self._load(dataset_ids, gene_ids, edge_types)
+        ids = set(gene_ids)
+        return self._network( self._edges(dataset_ids, edge_types, cutoff, lambda p: (p[0] in ids) and (p[1] in ids)) )
+
+    def expand(self, dataset_ids, entity_ids, edge_types):
+        """load neighbors of entity_ids, returns set of newly reached entity ids"""
+        before = set(self.nodes.keys())
+        self._load(dataset_ids, entity_ids, edge_types)
+        return set(self.nodes.keys()) - before
+
+    def adjacency(self, dataset_ids, edge_types, cutoff=None, undirected=True):
+        """cached edges as compressed sparse rows:
+        returns ids, indptr, indices, weights
+            ids     : list of entity ids, row / column order
+            indptr  : array, neighbors of ids[i] are indices[indptr[i]:indptr[i+1]]
+            indices : array of column numbers
+            weights : array of edge strengths
+        undirected adds each edge in both directions unless marked directed"""
+        edges = self._edges(dataset_ids, edge_types, cutoff)
+        ids   = sorted(set([e['nodeId1'] for e in edges] + [e['nodeId2'] for e in edges]))
+        pos   = dict([(x, i) for i, x in enumerate(ids)])
+        rows  = [ {} for x in ids ]
+        for e in edges:
+            a, b = pos[e['nodeId1']], pos[e['nodeId2']]
+            w = e.get('strength', 0) or 0
+            rows[a][b] = max(w, rows[a].get(b, w))
+            if undirected and (not e.get('directed')):
+                rows[b][a] = max(w, rows[b].get(a, w))
+        indptr  = array.array('l', [0])
+        indices = array.array('l')
+        weights = array.array('d')
+        for row in rows:
+            for col in sorted(row.keys()):
+                indices.append(col)
+                weights.append(row[col])
+            indptr.append(len(indices))
+        return ids, indptr, indices, weights
@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 
 import hashlib, traceback, math
-import expression, genopheno, networks, ontology
+import expression, genopheno, networks, ontology, geneindex
 from ipyTools import *
 
+# shared by all Plant objects: service clients per url set, and results already fetched
+_CLIENTS = {}
+_EXPERIMENTS = {} # genome id : get_experiments result
+_TRAITS = {}      # experiment id : get_traits result
+_TRACKS = {}      # (trait json, count) : VariationTrack of traits_to_variations result
+
+def plant_clients():
+    """returns dict of service clients shared by all Plant objects:
+        EXPRESSION, GENOPHENO, NETWORKS, ONTOLOGY
+    new clients are only created when service urls change"""
+    key = (Ipy.EXPRESSION_URL, Ipy.GENOPHENO_URL, Ipy.NETWORKS_URL, Ipy.ONTOLOGY_URL)
+    if key not in _CLIENTS:
+        _CLIENTS[key] = { 'EXPRESSION': expression.PlantExpression(Ipy.EXPRESSION_URL),
+                          'GENOPHENO': genopheno.Genotype_PhenotypeAPI(Ipy.GENOPHENO_URL),
+                          'NETWORKS': networks.KBaseNetworks(Ipy.NETWORKS_URL),
+                          'ONTOLOGY': ontology.Ontology(Ipy.ONTOLOGY_URL) }
+    return _CLIENTS[key]
+
 def get_plant_set(gids=[], def_name=None):
     """Wrapper for Plant object creation, checks if cache (created through unique option set) exists first and returns that.
     returns dict: key = plant_id, value = Plant() object
@@ -25,7 +43,9 @@ def get_plant_set(gids=[], def_name=None):
             (filename,line_number,function_name,text)=traceback.extract_stack()[-2]
             def_name = text[:text.find('=')].strip()
         print "Loading Plants for selected genomes through API. Please wait, this may take several minutes ..."
-        new_obj = dict([(x, Plant(genome_id=x, def_name="%s['%s']"%(def_name, x))) for x in gids])
+        clients = plant_clients()
+        load = lambda x: Plant(genome_id=x, def_name="%s['%s']"%(def_name, x), clients=clients)
+        new_obj = dict(zip(gids, map_concurrent(load, gids)))
         save_object(new_obj, cache_md5)
         print "Done loading through API"
         return new_obj
@@ -42,13 +62,18 @@ class Plant(object):
     self.experiments : result of self.GENOPHENO.get_experiments(self.genome_id)
     self.traits      : result of self.GENOPHENO.get_traits(self.experiments[1][0])
     self.display     : PlantDisplay Object - help(this_name.display)
+
+    service clients are shared between Plant objects (see plant_clients), experiments, traits and
+    variations are cached per genome / trait so they are only fetched once per session.
     """
-    def __init__(self, genome_id=None, def_name=None):
+    def __init__(self, genome_id=None, def_name=None, clients=None):
+        if not clients:
+            clients = plant_clients()
         self.genome_id   = genome_id
-        self.EXPRESSION  = expression.PlantExpression(Ipy.EXPRESSION_URL)
-        self.GENOPHENO   = genopheno.Genotype_PhenotypeAPI(Ipy.GENOPHENO_URL)
-        self.NETWORKS    = networks.KBaseNetworks(Ipy.NETWORKS_URL)
-        self.ONTOLOGY    = ontology.Ontology(Ipy.ONTOLOGY_URL)
+        self.EXPRESSION  = clients['EXPRESSION']
+        self.GENOPHENO   = clients['GENOPHENO']
+        self.NETWORKS    = clients['NETWORKS']
+        self.ONTOLOGY    = clients['ONTOLOGY']
         self.experiments = None
         self.traits      = None
         if self.genome_id:
@@ -61,11 +86,112 @@ class Plant(object):
         self.display = PlantDisplay(self, self.defined_name+'.display')
 
     def set_traits(self, genome_id):
-        self.experiments = self.GENOPHENO.get_experiments(genome_id)
-        self.traits = self.GENOPHENO.get_traits(self.experiments[1][0])
+        if genome_id not in _EXPERIMENTS:
+            _EXPERIMENTS[genome_id] = self.GENOPHENO.get_experiments(genome_id)
+        self.experiments = _EXPERIMENTS[genome_id]
+        exp_id = self.experiments[1][0]
+        if exp_id not in _TRAITS:
+            _TRAITS[exp_id] = self.GENOPHENO.get_traits(exp_id)
+        self.traits = _TRAITS[exp_id]
 
     def get_variations(self, count=5):
+        """raw traits_to_variations result, count is passed as the service pvaluecutoff. not cached,
+        use get_variation_track"""
         return self.GENOPHENO.traits_to_variations(self.traits[0], count)
+
+    def get_variation_track(self, count=5):
+        """returns VariationTrack of get_variations(count), built once per trait / count.
+        only the track is kept, the raw result is dropped once it is built"""
+        key = (json.dumps(self.traits[0], sort_keys=True), count)
+        if key not in _TRACKS:
+            _TRACKS[key] = VariationTrack(self.get_variations(count))
+        return _TRACKS[key]
+
+    def get_genes(self, count=5, distance=10000, pmin=None, pmax=None):
+        """genes within distance of variations of get_variation_track(count) with -log10(p-value) within pmin and pmax,
+        answered from the local geneindex.GeneIndex of this genome"""
+        index = geneindex.get_gene_index(self.genome_id)
+        return index.selected_locations_to_genes(self.get_variation_track(count), pmin, pmax, None, distance)
+
+class VariationTrack(object):
+    """Compact column store of GWAS variations for manhattan plots:
+        chrom  : array of chromosome index per variation
+        pos    : array of position per variation
+        logp   : array of -log10(p-value) per variation
+        length : { chromosome index : highest position seen }
+    variations are added in one pass (add can be called again with more), chromosome offsets and
+    y range are kept up to date as they are added.
+    """
+    def __init__(self, variations=None):
+        self.trait  = None
+        self.chrom  = array.array('i')
+        self.pos    = array.array('l')
+        self.logp   = array.array('d')
+        self.length = {}
+        self.y_min  = None
+        self.y_max  = None
+        if variations:
+            self.add(variations)
+
+    def add(self, variations):
+        """add traits_to_variations result, or list of [chromosome, position, p-value]"""
+        if isinstance(variations, dict):
+            if variations.get('trait'):
+                self.trait = variations['trait']
+            variations = variations.get('variations', [])
+        log10 = math.log(10)
+        for v in variations:
+            y = (math.log(toNum(v[2])) / log10) * -1.0
+            self.chrom.append(v[0])
+            self.pos.append(v[1])
+            self.logp.append(y)
+            if v[1] > self.length.get(v[0], 0):
+                self.length[v[0]] = v[1]
+            if (self.y_min is None) or (y < self.y_min):
+                self.y_min = y
+            if (self.y_max is None) or (y > self.y_max):
+                self.y_max = y
+
+    def __len__(self):
+        return len(self.pos)
+
+    def offsets(self, count=0):
+        """returns list of x offset per chromosome index, chromosomes laid out in index order"""
+        num  = max([count] + map(lambda x: x+1, self.length.keys()))
+        offs = []
+        for i in range(num):
+            if i == 0:
+                offs.append(10000)
+            else:
+                offs.append(offs[i-1] + self.length.get(i-1, 0) + 1000000)
+        return offs
+
+    def points(self, count=0, width=None, height=None, x_min=None, x_max=None):
+        """returns list per chromosome of {'x': .., 'y': ..} points sorted by x, within x_min / x_max.
+        if width and height, only one point per 2x2 pixel cell is kept, binned straight from the arrays"""
+        offs  = self.offsets(count)
+        x_lo  = offs[0] if x_min is None else x_min
+        x_hi  = (offs[-1] + self.length.get(len(offs)-1, 0)) if x_max is None else x_max
+        xspan = float(x_hi - x_lo) or 1.0
+        yspan = float(self.y_max - self.y_min) if len(self) else 0.0
+        yspan = yspan or 1.0
+        index = [ [] for x in offs ]
+        for i in xrange(len(self.pos)):
+            x = self.pos[i] + offs[self.chrom[i]]
+            if (x >= x_lo) and (x <= x_hi):
+                index[self.chrom[i]].append(i)
+        points = []
+        for c, idx in enumerate(index):
+            idx.sort(key=self.pos.__getitem__)
+            if width and height and (len(idx) > (width * 2)):
+                keep = {}
+                for i in idx:
+                    cell = (int((self.pos[i] + offs[c] - x_lo) / xspan * width / 2), int((self.logp[i] - self.y_min) / yspan * height / 2))
+                    if cell not in keep:
+                        keep[cell] = i
+                idx = sorted(keep.values(), key=self.pos.__getitem__)
+            points.append(map(lambda i: { "x": toNum(self.pos[i] + offs[c]), "y": self.logp[i] }, idx))
+        return points
             
 class PlantDisplay(object):
     """Class containing functions to display plant visualizations:
@@ -106,41 +232,33 @@ class PlantDisplay(object):
                 sys.stderr.write("Error producing traits table\n")
             return None
 
-    def variations(self, count=5, variations=None, title='', width=1100, height=400, x_min=0, x_max=None, arg_list=False):
+    def variations(self, count=5, variations=None, title='', width=1100, height=400, x_min=0, x_max=None, arg_list=False, downsample=True):
+        """manhattan plot of variations, points are reduced to one per 2x2 pixel cell if downsample,
+        pass a narrower x_min / x_max to see all points of a region.
+        variations may be a traits_to_variations result or a VariationTrack"""
         if not variations:
-            variations = self.plant.get_variations(count)
-        colors  = google_palette(count)
-        series  = []
-        points  = []
-        lengths = []
-        offsets = []
-        if not title:
-            title = "Manhattan Plot for %s"%variations["trait"]["trait_name"]
-        for i in range(count):
-            series.append({ "name": str(i+1), "color": colors[i], "shape": "circle"})
-            points.append([])
-            lengths.append(0)
-            offsets.append(0)
-        for i in variations["variations"]:
-            lengths[i[0]] = max(lengths[i[0]], i[1])
-        for i in range(len(lengths)):
-            if (i == 0):
-                offsets[i] = 10000
-            else:
-                offsets[i] = offsets[i-1] + lengths[i-1] + 1000000
-        y_all = []
-        for i in variations["variations"]:
-            y_log = (math.log(toNum(i[2])) / math.log(10)) * -1.0
-            y_all.append(y_log)
-            points[i[0]].append({ "x": toNum(i[1] + offsets[i[0]]), "y": y_log })
+            track = self.plant.get_variation_track(count)
+        elif isinstance(variations, VariationTrack):
+            track = variations
+        else:
+            track = VariationTrack(variations)
+        if not len(track):
+            sys.stderr.write("No variations to plot\n")
+            return None
+        if (not title) and track.trait:
+            title = "Manhattan Plot for %s"%track.trait["trait_name"]
+        offsets = track.offsets(count)
+        colors  = google_palette(len(offsets))
+        series  = map(lambda i: { "name": str(i+1), "color": colors[i], "shape": "circle"}, range(len(offsets)))
         if not x_max:
-            x_max = offsets[count-1] + lengths[count-1]
+            x_max = offsets[-1] + track.length.get(len(offsets)-1, 0)
+        points  = track.points(count, width if downsample else None, height, x_min, x_max)
         keyArgs = { 'width': width,
                     'height': height,
                     'x_min': x_min,
                     'x_max': x_max,
-                    'y_min': min(y_all),
-                    'y_max': max(y_all),
+                    'y_min': track.y_min,
+                    'y_max': track.y_max,
                     'connected': False,
                     'show_dots': True,
                     'data': {"series": series, "points": points}
@@ -154,4 +272,4 @@ class PlantDisplay(object):
                 Ipy.RETINA.plot(**keyArgs)
             except:
                 sys.stderr.write("Error producing manhattan plot\n")
-            return None
\ No newline at end of file
+            return None
@@ -21,7 +21,7 @@ class Project(Collection):
          "status"         : [ 'cv',     [ ['public', 'object is public'],
         						           ['private', 'object is private'] ] ]
     """
-    def __init__(self, pid, auth=None, def_name=None, cache=False):
+    def __init__(self, pid, auth=None, def_name=None, cache=False, lazy=False):
         # set project
         self._cfile = Ipy.CCH_DIR+'/'+pid+'.json'
         project = None
@@ -60,7 +60,7 @@ class Project(Collection):
                 pass
         self.defined_name = def_name
         # call collection init - from cache if given
-        Collection.__init__(self, self.mgids(), auth=auth, def_name=self.defined_name, cache=cache)
+        Collection.__init__(self, self.mgids(), auth=auth, def_name=self.defined_name, cache=cache, lazy=lazy)
     
     def _get_project(self, pid, auth):
         if Ipy.DEBUG:
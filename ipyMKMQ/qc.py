@@ -65,31 +65,28 @@ class Drisee(object):
         fhdl.close()
         return filename
 
-    def plot(self, width=800, height=300, title="", x_title="", y_title="", legend=True, arg_list=False, source='retina'):
+    def plot(self, width=800, height=300, title="", x_title="", y_title="", legend=True, arg_list=False, source='retina', x_min=None, x_max=None, downsample=True):
         if not self.percent:
             return None
         labels = self.percent['columns'][1:]
         x = map(lambda y: y[0], self.percent['data'])
         if source == 'retina':
             series = []
+            points = []
             colors = google_palette(len(labels))
             for i, l in enumerate(labels):
                 series.append({'name': l, 'color': colors[i]})
-            pA = map(lambda y: {'x': y[0], 'y': y[1]}, self.percent['data'])
-            pT = map(lambda y: {'x': y[0], 'y': y[2]}, self.percent['data'])
-            pC = map(lambda y: {'x': y[0], 'y': y[3]}, self.percent['data'])
-            pG = map(lambda y: {'x': y[0], 'y': y[4]}, self.percent['data'])
-            pN = map(lambda y: {'x': y[0], 'y': y[5]}, self.percent['data'])
-            pX = map(lambda y: {'x': y[0], 'y': y[6]}, self.percent['data'])
-            pTot = map(lambda y: {'x': y[0], 'y': y[7]}, self.percent['data'])
-            data = {'series': series, 'points': [pA, pT, pC, pG, pN, pX, pTot]}
+                # columns: A, T, C, G, N, InDel, Total
+                pts = map(lambda y: {'x': y[0], 'y': y[i+1]}, self.percent['data'])
+                points.append( downsample_points(pts, width if downsample else None, x_min=x_min, x_max=x_max) )
+            data = {'series': series, 'points': points}
             keyArgs = { 'width': width,
                         'height': height,
                         'title': 'drisee plot' if not title else title,
                         'x_title': x_title,
                         'y_title': y_title,
-                        'x_min': min(x),
-                        'x_max': max(x),
+                        'x_min': min(x) if x_min is None else x_min,
+                        'x_max': max(x) if x_max is None else x_max,
                         'y_min': 0,
                         'y_max': 100,
                         'target': 'div_plot_'+random_str(),
@@ -145,7 +142,7 @@ class NucleoProfile(object):
         except:
             return None
 
-    def plot(self, width=800, height=300, title="", legend=True, arg_list=False, source='retina'):
+    def plot(self, width=800, height=300, title="", legend=True, arg_list=False, source='retina', downsample=True):
         if not self.percent:
             return None
         labels = self.percent['columns'][1:]
@@ -156,9 +153,12 @@ class NucleoProfile(object):
             colors = google_palette(len(labels))
             for i, l in enumerate(labels):
                 data.append({'name': l, 'fill': colors[i], 'data': []})
-            for n, row in enumerate(self.percent['data']):
+            # stacked series share positions, keep every step-th position for more than 1 per pixel
+            step = int(math.ceil(len(self.percent['data']) / float(width))) if downsample and width else 1
+            rows = self.percent['data'][::max(step, 1)]
+            for n, row in enumerate(rows):
                 if (n % 10) == 0:
-                    x_label.append(str(n))
+                    x_label.append(str(n * max(step, 1)))
                     x_tick += 1
                 for i, d in enumerate(row[1:]):
                     data[i]['data'].append(toNum(d))
@@ -169,7 +169,7 @@ class NucleoProfile(object):
                         'x_title': 'bp position',
                         'y_title': 'percent bp',
                         'x_labels': x_label,
-                        'x_tick_interval': int(len(self.percent['data'])/50),
+                        'x_tick_interval': int(len(rows)/50),
                         'x_labeled_tick_interval': x_tick,
                         'btype': 'stackedArea',
                         'target': 'div_graph_'+random_str(),
@@ -225,47 +225,48 @@ class Kmer(object):
             except:
                 return None
 
-    def plot_abundance(self, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina'):
+    def plot_abundance(self, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina', x_min=None, x_max=None, downsample=True):
         if not (self.profile and ('data' in self.profile)):
             return None
         points = map(lambda z: {'x': math.log(z[3], 10), 'y': math.log(z[0], 10)}, self.profile['data'])
         tt = 'kmer rank abundance' if not title else title
         xt = 'sequence size' if not x_title else x_title
         yt = 'kmer coverage' if not y_title else y_title
-        return self._plot(points=points, width=width, height=height, title=tt, x_title=xt, y_title=yt, arg_list=arg_list, source=source)
+        return self._plot(points=points, width=width, height=height, title=tt, x_title=xt, y_title=yt, arg_list=arg_list, source=source, x_min=x_min, x_max=x_max, downsample=downsample)
 
-    def plot_ranked(self, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina'):
+    def plot_ranked(self, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina', x_min=None, x_max=None, downsample=True):
         if not (self.profile and ('data' in self.profile)):
             return None
         points = map(lambda z: {'x': math.log(z[3], 10), 'y': 1 - (1.0 * z[5])}, self.profile['data'])
         tt = 'ranked kmer consumed' if not title else title
         xt = 'sequence size' if not x_title else x_title
         yt = 'fraction of observed kmers' if not y_title else y_title
-        return self._plot(points=points, width=width, height=height, title=tt, x_title=xt, y_title=yt, arg_list=arg_list, source=source)
+        return self._plot(points=points, width=width, height=height, title=tt, x_title=xt, y_title=yt, arg_list=arg_list, source=source, x_min=x_min, x_max=x_max, downsample=downsample)
 
-    def plot_spectrum(self, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina'):
+    def plot_spectrum(self, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina', x_min=None, x_max=None, downsample=True):
         if not (self.profile and ('data' in self.profile)):
             return None
         points = map(lambda z: {'x': math.log(z[0], 10), 'y': math.log(z[1], 10)}, self.profile['data'])
         tt = 'kmer spectrum' if not title else title
         xt = 'kmer coverage' if not x_title else x_title
         yt = 'number of kmers' if not y_title else y_title
-        return self._plot(points=points, width=width, height=height, title=tt, x_title=xt, y_title=yt, arg_list=arg_list, source=source)
+        return self._plot(points=points, width=width, height=height, title=tt, x_title=xt, y_title=yt, arg_list=arg_list, source=source, x_min=x_min, x_max=x_max, downsample=downsample)
         
-    def _plot(self, points=None, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina'):
+    def _plot(self, points=None, width=800, height=300, title="", x_title="", y_title="", arg_list=False, source='retina', x_min=None, x_max=None, downsample=True):
         if not points:
             return None
         x = map(lambda z: z['x'], points)
         y = map(lambda z: z['y'], points)
         if source == 'retina':
+            points = downsample_points(sorted(points, key=lambda z: z['x']), width if downsample else None, x_min=x_min, x_max=x_max)
             data = {'series': [{'name': title}], 'points': [points]}
             keyArgs = { 'width': width,
                         'height': height,
                         'title': title,
                         'x_title': x_title,
                         'y_title': y_title,
-                        'x_min': min(x),
-                        'x_max': max(x),
+                        'x_min': min(x) if x_min is None else x_min,
+                        'x_max': max(x) if x_max is None else x_max,
                         'y_min': min(y),
                         'y_max': max(y),
                         'target': 'div_plot_'+random_str(),
@@ -321,7 +322,7 @@ class Rarefaction(object):
         except:
             return None, None
     
-    def plot(self, mgids=None, width=800, height=300, title="", x_title="", y_title="", legend=True, arg_list=False, source='retina'):
+    def plot(self, mgids=None, width=800, height=300, title="", x_title="", y_title="", legend=True, arg_list=False, source='retina', x_min=None, x_max=None, downsample=True):
         if not self.points:
             return None
         tt = 'rarefaction curve' if not title else title
@@ -337,16 +338,21 @@ class Rarefaction(object):
                     continue
                 a = " (%0.2f)"%float(self.alpha[m]) if self.alpha[m] else ''
                 series.append( {'name': m+a, 'color': colors[i]} )
-                points.append( map(lambda z: {'x': toNum(z[0]), 'y': toNum(z[1])}, self.points[m]) )
-                x_all.extend( map(lambda z: toNum(z[0]), self.points[m]) )
-                y_all.extend( map(lambda z: toNum(z[1]), self.points[m]) )
+                pts = map(lambda z: {'x': toNum(z[0]), 'y': toNum(z[1])}, self.points[m])
+                pts = downsample_points(pts, width if downsample else None, x_min=x_min, x_max=x_max)
+                points.append(pts)
+                x_all.extend( map(lambda z: z['x'], pts) )
+                y_all.extend( map(lambda z: z['y'], pts) )
+            if not y_all:
+                sys.stderr.write("Error: no rarefaction points within x_min / x_max\n")
+                return None
             keyArgs = { 'width': width,
                         'height': height,
                         'title': tt,
                         'x_title': x_title,
                         'y_title': y_title,
-                        'x_min': min(x_all),
-                        'x_max': max(x_all),
+                        'x_min': min(x_all) if x_min is None else x_min,
+                        'x_max': max(x_all) if x_max is None else x_max,
                         'y_min': min(y_all),
                         'y_max': max(y_all),
                         'target': 'div_plot_'+random_str(),
@@ -79,24 +79,24 @@ class Retina(object):
                 clean_obj = target+".issorted = "+target+".sorted; delete "+target+".sorted; "
                 clean_obj += target+".filtertypes = "+target+".filter; delete "+target+".filter;"
             src = """
-			    (function(){
+			    (window.ipy_mg_when || function(f) { f(); })(function(){
 			        var """+target+""" = """+widget+"""."""+function+"""; """+clean_obj+"""
 			        var ipy_cmd = JSON.stringify("""+target+""").replace("true", "True").replace("false", "False");
 			        var new_idx = ipy.add_cell(undefined, 'code', 'above');
 			        ipy.write_cell(new_idx, '"""+target+""" = '+ipy_cmd);
 			        ipy.execute_cell(new_idx);
-                })();
+                });
 		    """
         else:
             html = "<div id='%s'></div>"%(target)
             src = """
-			    (function(){
+			    (window.ipy_mg_when || function(f) { f(); })(function(){
 			        var """+target+""" = """+widget+"""."""+function+""";
 			        """+target+""".target = document.getElementById('"""+target+"""');
 				    Retina.load_renderer(\""""+viz_type+"""\").then( function () { 
 				        Retina.Renderer.create('"""+viz_type+"""', """+target+""").render();
 				    });
-                })();
+                });
 		    """
         if self.debug:
             print src
@@ -142,24 +142,24 @@ class Retina(object):
                 clean_obj = target+".issorted = "+target+".sorted; delete "+target+".sorted; "
                 clean_obj += target+".filtertypes = "+target+".filter; delete "+target+".filter;"
             src = """
-			    (function(){
+			    (window.ipy_mg_when || function(f) { f(); })(function(){
 			        var """+target+""" = """+widget+"""."""+function+"""; """+clean_obj+"""
 			        var ipy_cmd = JSON.stringify("""+target+""").replace(/true/g, "True").replace(/false/g, "False");
 			        var new_idx = ipy.add_cell(undefined, 'code', 'above');
 			        ipy.write_cell(new_idx, '"""+target+""" = '+ipy_cmd);
 			        ipy.execute_cell(new_idx);
-                })();
+                });
 		    """
         else:
             html = "<div id='%s'></div>"%(target)
             src = """
-			    (function(){
+			    (window.ipy_mg_when || function(f) { f(); })(function(){
 			        var """+target+""" = """+widget+"""."""+function+""";
 			        """+target+""".target = document.getElementById('"""+target+"""');
 				    Retina.load_renderer(\""""+viz_type+"""\").then( function () { 
 				        Retina.Renderer.create('"""+viz_type+"""', """+target+""").render();
 				    });
-                })();
+                });
 		    """
         if self.debug:
             print src
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import sys, json, socket, threading, itertools
+import httplib, urlparse
+import instrument
+from urllib2 import URLError
+from ipyTools import *
+
+class RPCClient(object):
+    """Shared JSON-RPC core for the generated KBase service clients
+    (cdmi.CDMI_API, cdmi.CDMI_EntityAPI, networks.KBaseNetworks, genopheno.Genotype_PhenotypeAPI,
+    expression.PlantExpression, ontology.Ontology).
+
+    Wraps a client object, requests go over one persistent connection per thread:
+        call(method, *params)            : single call, same result as client.method(*params)
+        batch([(method, params), ...])   : several calls in one batched request if the server accepts
+                                           batches, else sent one after the other over the same connection
+        scatter(method, ids, *params)    : split ids into chunks of chunk_size, run chunks concurrently
+                                           (batched by batch_size if supported), merge results
+        any client method name           : rpc.fids_to_functions(fids) == rpc.call('fids_to_functions', fids)
+    errors raise the ServerError class of the wrapped client's module.
+    """
+    def __init__(self, client, chunk_size=1000, batch_size=10):
+        self.client  = client
+        self.service = client.__class__.__name__
+        self.url     = client.url
+        self.timeout = client.timeout
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.batching = None # None = not yet tested
+        self.ServerError = getattr(sys.modules[client.__class__.__module__], 'ServerError', Exception)
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or (not hasattr(self.client, name)):
+            raise AttributeError(name)
+        return lambda *params: self.call(name, *params)
+
+    def _connection(self, reset=False):
+        conn = getattr(self._local, 'conn', None)
+        if reset and conn:
+            conn.close()
+            conn = None
+        if conn is None:
+            parts = urlparse.urlparse(self.url)
+            ctype = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+            conn = ctype(parts.netloc, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _post(self, obj):
+        body = json.dumps(obj)
+        path = urlparse.urlparse(self.url).path or '/'
+        method = obj['method'] if isinstance(obj, dict) else 'batch'
+        with instrument.span('rpc', url=self.url, method=method):
+            for attempt in (0, 1):
+                conn = self._connection(reset=(attempt > 0))
+                try:
+                    conn.request('POST', path, body, {'Content-Type': 'application/json'})
+                    res  = conn.getresponse()
+                    data = res.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    # stale keep-alive connection, retry once on a new one
+                    if attempt > 0:
+                        raise
+        instrument.count('rpc.bytes_sent', len(body))
+        instrument.count('rpc.bytes', len(data))
+        with instrument.span('json.decode'):
+            try:
+                resp = json.loads(data)
+            except ValueError:
+                resp = None
+        if res.status != httplib.OK:
+            if isinstance(resp, dict) and ('error' in resp):
+                raise self.ServerError(**resp['error'])
+            raise URLError('Received bad response code from server:' + str(res.status))
+        return resp
+
+    def _request(self, method, params):
+        return { 'method': self.service+'.'+method,
+                 'params': list(params),
+                 'version': '1.1',
+                 'id': str(next(self._ids)) }
+
+    def _result(self, resp):
+        if isinstance(resp, dict) and ('result' in resp):
+            return resp['result'][0]
+        if isinstance(resp, dict) and resp.get('error'):
+            raise self.ServerError(**resp['error'])
+        raise self.ServerError('Unknown', 0, 'An unknown server error occurred')
+
+    def call(self, method, *params):
+        return self._result( self._post(self._request(method, params)) )
+
+    def batch(self, calls):
+        """input: list of (method, params) tuples
+        return: list of results in same order"""
+        if not calls:
+            return []
+        reqs = map(lambda x: self._request(x[0], x[1]), calls)
+        if (self.batching is not False) and (len(reqs) > 1):
+            try:
+                resp = self._post(reqs)
+            except (self.ServerError, URLError):
+                resp = None
+            if isinstance(resp, list) and (len(resp) == len(reqs)):
+                self.batching = True
+                by_id = dict([(r.get('id'), r) for r in resp])
+                return map(lambda x: self._result(by_id.get(x['id'])), reqs)
+            if Ipy.DEBUG:
+                sys.stdout.write("%s does not accept batched requests, pipelining\n"%self.url)
+            self.batching = False
+        # pipeline over persistent connection
+        return map(lambda x: self._result(self._post(x)), reqs)
+
+    def scatter(self, method, ids, *params, **kwargs):
+        """call method(ids_chunk, *params) for chunks of ids concurrently and merge results:
+        dict results are merged into one dict, list results are concatenated.
+        keyword chunk_size overrides default chunk size"""
+        size   = kwargs.get('chunk_size', self.chunk_size)
+        chunks = [ ids[i:i+size] for i in xrange(0, len(ids), size) ]
+        if not chunks:
+            return {}
+        calls  = map(lambda x: (method, [x]+list(params)), chunks)
+        if self.batching is False:
+            results = map_concurrent(lambda x: self.call(x[0], *x[1]), calls)
+        else:
+            groups  = [ calls[i:i+self.batch_size] for i in xrange(0, len(calls), self.batch_size) ]
+            results = sum(map_concurrent(self.batch, groups), [])
+        return gather(results)
+
+def gather(results):
+    """merge list of dict results into one dict, or list of list results into one list"""
+    if results and all(map(lambda x: isinstance(x, dict), results)):
+        merged = {}
+        for r in results:
+            merged.update(r)
+        return merged
+    merged = []
+    for r in results:
+        if r:
+            merged.extend(r)
+    return merged
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""Host wide store of loaded matrices in shared memory (Ipy.SHM_DIR, ie. /dev/shm/ipymkmq), off by default.
+
+The first kernel to load a matrix publishes it as memory-mapped files (see mmatrix.py) named by the
+matrix md5 of AnalysisSet._get_analysis, other kernels attach to these files read-only instead of
+downloading and parsing it again. Memory used grows with the number of distinct matrices, not kernels.
+
+The directory is shared by all local users (mode 1777, like /tmp). Only files owned by you, or by one of
+the groups in Ipy.SHM_TRUSTED_GIDS, are attached. Matrices loaded with an auth token are never published
+or attached. Publishing removes your matrices unused for Ipy.SHM_MAX_AGE seconds, then the least recently
+used ones while the store is larger than Ipy.SHM_MAX_MB.
+"""
+
+import sys, os, glob, stat
+from time import time
+from ipyTools import *
+from mmatrix import biom_to_mapped, open_mapped, SUFFIX
+
+def _store_dir(create=False):
+    if not Ipy.SHM_DIR:
+        return None
+    if create and (not os.path.isdir(Ipy.SHM_DIR)):
+        try:
+            os.makedirs(Ipy.SHM_DIR)
+            os.chmod(Ipy.SHM_DIR, 01777)
+        except OSError:
+            # created by another kernel meanwhile, or not allowed
+            pass
+    return Ipy.SHM_DIR if os.path.isdir(Ipy.SHM_DIR) else None
+
+def _trusted(fname):
+    """True if fname is a regular file owned by you or a trusted group, and not writable by others"""
+    try:
+        st = os.lstat(fname)
+    except OSError:
+        return False
+    if (not stat.S_ISREG(st.st_mode)) or (st.st_mode & stat.S_IWOTH):
+        return False
+    return (st.st_uid == os.getuid()) or (st.st_gid in Ipy.SHM_TRUSTED_GIDS)
+
+def shared_matrix(md5):
+    """returns sidecar file of published matrix md5, None if not published or not trusted"""
+    if not Ipy.SHM_DIR:
+        return None
+    side = os.path.join(Ipy.SHM_DIR, md5+SUFFIX+'.json')
+    if os.path.isfile(side):
+        if _trusted(side):
+            instrument.count('cache.shared.hit')
+            return side
+        sys.stderr.write("Ignoring shared matrix %s: not owned by you or a trusted group\n"%side)
+    instrument.count('cache.shared.miss')
+    return None
+
+def publish_matrix(md5, biom):
+    """publish BIOM object as matrix md5, returns sidecar file, None if the store is not available.
+    files are renamed into place, kernels attaching at the same time see the old or the new copy"""
+    sdir = _store_dir(create=True)
+    if (not sdir) or (not biom) or ('data' not in biom):
+        return None
+    evict_shared()
+    try:
+        with instrument.span('shared.publish'):
+            side = biom_to_mapped(biom, os.path.join(sdir, md5+SUFFIX))
+        for fname in (side, side[:-5]):
+            os.chmod(fname, 0644)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Error publishing matrix %s to %s: %s\n"%(md5, sdir, e))
+        return None
+    return side
+
+def attach_matrix(md5):
+    """returns BIOM object of published matrix md5 with 'data' mapped read-only, None if not published or not trusted"""
+    side = shared_matrix(md5)
+    if not side:
+        return None
+    try:
+        biom = open_mapped(side)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Error attaching shared matrix %s: %s\n"%(md5, e))
+        return None
+    if not _trusted(biom['data'].fname):
+        sys.stderr.write("Ignoring shared matrix %s: not owned by you or a trusted group\n"%biom['data'].fname)
+        return None
+    try:
+        # mark as used for evict_shared
+        os.utime(side, None)
+    except OSError:
+        pass
+    return biom
+
+def shared_matrices():
+    """returns { md5 : bytes } of all published matrices"""
+    sdir = _store_dir()
+    if not sdir:
+        return {}
+    found = {}
+    for fname in glob.glob(os.path.join(sdir, '*'+SUFFIX)):
+        if not os.path.isfile(fname+'.json'):
+            continue # being published
+        found[os.path.basename(fname)[:-len(SUFFIX)]] = os.path.getsize(fname) + os.path.getsize(fname+'.json')
+    return found
+
+def unpublish_matrix(md5):
+    """remove matrix md5 from the store, kernels already attached keep their mapping"""
+    sdir = _store_dir()
+    if not sdir:
+        return False
+    base = os.path.join(sdir, md5+SUFFIX)
+    try:
+        os.remove(base+'.json')
+        os.remove(base)
+    except OSError:
+        return False
+    return True
+
+def evict_shared(max_bytes=None, max_age=None):
+    """remove your published matrices not used for max_age seconds (default Ipy.SHM_MAX_AGE), then your least
+    recently used ones while the store holds more than max_bytes (default Ipy.SHM_MAX_MB). returns removed md5s"""
+    sdir = _store_dir()
+    if not sdir:
+        return []
+    if max_bytes is None:
+        max_bytes = Ipy.SHM_MAX_MB * 1024 * 1024 if Ipy.SHM_MAX_MB else 0
+    if max_age is None:
+        max_age = Ipy.SHM_MAX_AGE or 0
+    now = time()
+    uid = os.getuid()
+    # left over temp files of interrupted publishes
+    for fname in glob.glob(os.path.join(sdir, '*'+SUFFIX+'.tmp*')):
+        try:
+            st = os.lstat(fname)
+            if (st.st_uid == uid) and (now - st.st_mtime > 3600):
+                os.remove(fname)
+        except OSError:
+            pass
+    total = 0
+    used  = [] # (last use, bytes, md5) of your matrices
+    for md5, size in shared_matrices().iteritems():
+        total += size
+        base = os.path.join(sdir, md5+SUFFIX)
+        try:
+            side, data = os.lstat(base+'.json'), os.lstat(base)
+        except OSError:
+            continue
+        if side.st_uid == uid:
+            used.append(( max(side.st_atime, side.st_mtime, data.st_atime), size, md5 ))
+    removed = []
+    for last, size, md5 in sorted(used):
+        if (max_age and (now - last > max_age)) or (max_bytes and (total > max_bytes)):
+            if unpublish_matrix(md5):
+                total -= size
+                removed.append(md5)
+    return removed